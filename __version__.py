@@ -2,13 +2,34 @@
 
 import os
 
+_VERSION_FILE = os.path.join(os.path.dirname(__file__), 'VERSION')
+
+# Cache of version file path -> (mtime_ns, version)
+_version_cache = {}
+
 def get_version():
-    """Get the version from the VERSION file."""
-    version_file = os.path.join(os.path.dirname(__file__), 'VERSION')
+    """
+    Get the version from the VERSION file.
+
+    The file is only re-read when its modification time changes, so repeated
+    calls in a long-running process cost a single stat.
+    """
     try:
-        with open(version_file, 'r', encoding='utf-8') as f:
-            return f.read().strip()
+        mtime = os.stat(_VERSION_FILE).st_mtime_ns
     except FileNotFoundError:
         return 'unknown'
 
+    cached = _version_cache.get(_VERSION_FILE)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    try:
+        with open(_VERSION_FILE, 'r', encoding='utf-8') as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return 'unknown'
+
+    _version_cache[_VERSION_FILE] = (mtime, version)
+    return version
+
 __version__ = get_version()
@@ -25,6 +25,7 @@
         dontUseSetuptools = true;
 
         propagatedBuildInputs = with pyPkgs; [
+          orjson
           pillow
           qrcode
           requests
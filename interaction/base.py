@@ -16,6 +16,17 @@ class InteractionProvider(ABC):
         """
         return False
     
+    @property
+    def supports_ascii_qr(self):
+        """
+        Indicates if the QR code should be printed as text in the terminal
+        instead of being rendered to an image for display_qr_code().
+        
+        Returns:
+            bool: True if the QR code should be printed, False otherwise
+        """
+        return False
+    
     def listen(self, callback, **kwargs):
         """
         Listen for triggers and call the callback function when triggered.
@@ -55,6 +66,26 @@ class InteractionProvider(ABC):
         """
         pass
     
+    @staticmethod
+    def _format_stats(stats):
+        """
+        Format completion statistics for display.
+        
+        Args:
+            stats (dict): Statistics as passed to report_completion()
+            
+        Returns:
+            str: One line each for receipts and letters, with the fetched count
+                reading e.g. "12" or "5 of 12"
+        """
+        receipts_count = stats['receipts_total'] if stats['receipts_fetched'] == stats['receipts_total'] else f"{stats['receipts_fetched']} of {stats['receipts_total']}"
+        letters_count = stats['letters_total'] if stats['letters_fetched'] == stats['letters_total'] else f"{stats['letters_fetched']} of {stats['letters_total']}"
+        summary_text = (
+            f"Receipts: {stats.get('receipts_stored', 0)} new items, {receipts_count} fetched\n"
+            f"Letters: {stats.get('letters_stored', 0)} new items, {letters_count} fetched"
+        )
+        return summary_text
+    
     @abstractmethod
     def report_authentication_success(self):
         """
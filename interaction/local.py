@@ -1,13 +1,32 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-from PIL import Image
 import logging
 from interaction.base import InteractionProvider
 
 class LocalInteractionProvider(InteractionProvider):
     """Default interaction provider that displays QR codes locally and reports to console."""
     
+    def __init__(self, ascii_qr=False):
+        """
+        Initialize the local interaction provider.
+        
+        Args:
+            ascii_qr (bool, optional): Print the QR code in the terminal instead of
+                                       opening it in an image viewer. Defaults to False.
+        """
+        self.ascii_qr = ascii_qr
+    
+    @property
+    def supports_ascii_qr(self):
+        """
+        Indicates if the QR code should be printed in the terminal.
+        
+        Returns:
+            bool: True if the provider was created with ascii_qr
+        """
+        return self.ascii_qr
+    
     def display_qr_code(self, qr_image_path):
         """
         Display a QR code for BankID authentication.
@@ -17,6 +36,8 @@ class LocalInteractionProvider(InteractionProvider):
         """
         # Open the image with the system's default image viewer
         try:
+            # Imported here so headless setups using other providers don't pay for PIL
+            from PIL import Image
             Image.open(qr_image_path).show()
             print(f"QR code has been saved as: {qr_image_path}")
         except Exception as e:
@@ -31,10 +52,8 @@ class LocalInteractionProvider(InteractionProvider):
             stats (dict): Statistics including receipts and letters counts
         """
         print("\nAll done!")
-        receipts_count = stats['receipts_total'] if stats['receipts_fetched'] == stats['receipts_total'] else f"{stats['receipts_fetched']} of {stats['receipts_total']}"
-        letters_count = stats['letters_total'] if stats['letters_fetched'] == stats['letters_total'] else f"{stats['letters_fetched']} of {stats['letters_total']}"
-        print(f"Receipts: {stats.get('receipts_stored', 0)} new items, {receipts_count} fetched")
-        print(f"Letters: {stats.get('letters_stored', 0)} new items, {letters_count} fetched")
+        summary_text = self._format_stats(stats)
+        print(summary_text)
     
     def report_authentication_success(self):
         """
@@ -2,18 +2,28 @@
 # -*- coding: utf-8 -*-
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import ReadTimeoutError
 import logging
 import os
 import base64
 import json
-import time
 import signal
-import sys
+import threading
+import concurrent.futures
 from interaction.base import InteractionProvider
 
+# (connect, read) timeouts for the listen stream. ntfy sends keepalives well
+# within the read timeout, so hitting it means the connection is dead.
+LISTEN_TIMEOUT = (10, 90)
+
 class NtfyInteractionProvider(InteractionProvider):
     """Interaction provider that uses ntfy.sh for notifications."""
     
+    # Signal handlers are process-wide, install them only once
+    _handlers_installed = False
+    
     def __init__(self, topic, server="https://ntfy.sh", headers=None, trigger_message="run now"):
         """
         Initialize the ntfy interaction provider.
@@ -28,6 +38,48 @@ class NtfyInteractionProvider(InteractionProvider):
         self.ntfy_server = server.rstrip('/')
         self.ntfy_headers = headers or {}
         self.trigger_message = trigger_message
+        self._post_url = f"{self.ntfy_server}/{self.ntfy_topic}"
+        self._stream_url = f"{self.ntfy_server}/{self.ntfy_topic}/json"
+        self._trigger_casefold = trigger_message.casefold()
+        
+        # Raw bytes to look for in a stream line before parsing it as JSON. Only
+        # usable when the trigger is plain ASCII that JSON encodes verbatim.
+        if trigger_message.isascii() and trigger_message.isprintable() and not any(c in trigger_message for c in '"\\<>&'):
+            self._trigger_bytes = self._trigger_casefold.encode('utf-8')
+        else:
+            self._trigger_bytes = None
+        
+        # Reuse connections across notifications and the listen loop
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=2,
+            pool_maxsize=4,
+            max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+        )
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        
+        # Notifications are sent in the background so they don't hold up the sync
+        self._notify_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='ntfy')
+        
+        # Set to stop the listen loop
+        self._stop = threading.Event()
+        self._response = None
+        
+        # True while a triggered sync is running
+        self._in_callback = False
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+    
+    def close(self):
+        """Send any pending notifications and close the underlying HTTP session."""
+        self._notify_pool.shutdown(wait=True)
+        self._session.close()
         
     @property
     def can_listen(self):
@@ -46,25 +98,24 @@ class NtfyInteractionProvider(InteractionProvider):
         Args:
             qr_image_path (str): Path to the QR code image file
         """
-        # Read the image file
         try:
-            with open(qr_image_path, 'rb') as f:
-                image_data = f.read()
-            
             # Send notification with QR code
             headers = {
                 "Title": "Kivra authentication",
                 "Priority": "urgent",
                 "Filename": os.path.basename(qr_image_path),
                 "Content-Type": "application/octet-stream",
+                "Content-Length": str(os.path.getsize(qr_image_path)),
                 **self.ntfy_headers
             }
             
-            response = requests.post(
-                f"{self.ntfy_server}/{self.ntfy_topic}",
-                data=image_data,
-                headers=headers
-            )
+            # Stream the image file instead of reading it into memory first
+            with open(qr_image_path, 'rb') as f:
+                response = self._session.post(
+                    self._post_url,
+                    data=f,
+                    headers=headers
+                )
             
             if response.status_code != 200:
                 logging.error(f"Failed to send QR code via ntfy: {response.status_code}, {response.text}")
@@ -84,52 +135,98 @@ class NtfyInteractionProvider(InteractionProvider):
             callback (callable): Function to call when triggered
             **kwargs: Additional arguments for the callback
         """
-        url = f"{self.ntfy_server}/{self.ntfy_topic}/json"
+        url = self._stream_url
         
         logging.info(f"Listening for messages on {url}")
         logging.info(f"Trigger message: '{self.trigger_message}'")
         
-        # Set up signal handlers for graceful shutdown
-        def signal_handler(sig, frame):
-            logging.info("Received signal to terminate, shutting down...")
-            sys.exit(0)
-        
-        signal.signal(signal.SIGINT, signal_handler)
-        signal.signal(signal.SIGTERM, signal_handler)
+        # Set up signal handlers for graceful shutdown. signal.signal() may only
+        # be called from the main thread.
+        if not NtfyInteractionProvider._handlers_installed and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self._handle_signal)
+            signal.signal(signal.SIGTERM, self._handle_signal)
+            NtfyInteractionProvider._handlers_installed = True
         
         # Start listening
-        while True:
-            try:
-                with requests.get(url, headers=self.ntfy_headers, stream=True) as response:
-                    if response.status_code != 200:
-                        logging.error(f"Failed to connect to ntfy server: {response.status_code}, {response.text}")
-                        time.sleep(10)  # Wait before retrying
-                        continue
-                    
-                    for line in response.iter_lines():
-                        if not line:
+        try:
+            while not self._stop.is_set():
+                try:
+                    with self._session.get(url, headers=self.ntfy_headers, stream=True, timeout=LISTEN_TIMEOUT) as response:
+                        if response.status_code != 200:
+                            logging.error(f"Failed to connect to ntfy server: {response.status_code}, {response.text}")
+                            self._stop.wait(10)  # Wait before retrying
                             continue
                         
-                        try:
-                            message = json.loads(line.decode('utf-8'))
-                            message_text = message.get('message', '')
-                            if message_text != '':
-                                logging.info(f"Received message: {message_text}")
+                        self._response = response
+                        for line in response.iter_lines(chunk_size=8192):
+                            if self._stop.is_set():
+                                break
+                            if not line:
+                                continue
                             
-                            if message_text.lower() == self.trigger_message.lower():
-                                logging.info("Trigger message received, running callback")
-                                callback()
-                        except json.JSONDecodeError:
-                            logging.error(f"Failed to parse message: {line.decode('utf-8')}")
-                        except Exception as e:
-                            logging.error(f"Error processing message: {str(e)}")
-            
-            except requests.exceptions.RequestException as e:
-                logging.error(f"Connection error: {str(e)}")
-                time.sleep(10)  # Wait before retrying
-            except Exception as e:
-                logging.error(f"Unexpected error: {str(e)}")
-                time.sleep(10)  # Wait before retrying
+                            # Skip keepalives and unrelated messages without parsing them
+                            if self._trigger_bytes is not None and self._trigger_bytes not in line.lower():
+                                continue
+                            
+                            try:
+                                message = json.loads(line.decode('utf-8'))
+                                message_text = message.get('message', '')
+                                if message_text != '':
+                                    logging.info(f"Received message: {message_text}")
+                                
+                                if message_text.casefold() == self._trigger_casefold:
+                                    logging.info("Trigger message received, running callback")
+                                    self._in_callback = True
+                                    try:
+                                        callback()
+                                    finally:
+                                        self._in_callback = False
+                            except json.JSONDecodeError:
+                                logging.error(f"Failed to parse message: {line.decode('utf-8')}")
+                            except Exception as e:
+                                logging.error(f"Error processing message: {str(e)}")
+                
+                except requests.exceptions.ReadTimeout:
+                    # Normal long-poll rollover, reconnect immediately
+                    logging.debug("Listen stream timed out, reconnecting")
+                except requests.exceptions.RequestException as e:
+                    if self._stop.is_set():
+                        break
+                    if isinstance(e, requests.exceptions.ConnectionError) and e.args and isinstance(e.args[0], ReadTimeoutError):
+                        # Read timeout raised while iterating the stream
+                        logging.debug("Listen stream timed out, reconnecting")
+                        continue
+                    logging.error(f"Connection error: {str(e)}")
+                    self._stop.wait(10)  # Wait before retrying
+                except Exception as e:
+                    if self._stop.is_set():
+                        break
+                    logging.error(f"Unexpected error: {str(e)}")
+                    self._stop.wait(10)  # Wait before retrying
+                finally:
+                    self._response = None
+        finally:
+            self.close()
+    
+    def _handle_signal(self, sig, frame):
+        """
+        Stop the listen loop on SIGINT/SIGTERM. A sync that is already running
+        is aborted by raising SystemExit from the handler.
+        
+        Args:
+            sig (int): Signal number
+            frame (frame): Current stack frame
+        """
+        logging.info("Received signal to terminate, shutting down...")
+        if self._in_callback:
+            raise SystemExit(0)
+        
+        self._stop.set()
+        
+        # Interrupt a blocking read on the listen stream
+        response = self._response
+        if response is not None:
+            response.close()
     
     def report_completion(self, stats):
         """
@@ -138,13 +235,8 @@ class NtfyInteractionProvider(InteractionProvider):
         Args:
             stats (dict): Statistics including receipts and letters counts
         """
-        receipts_count = stats['receipts_total'] if stats['receipts_fetched'] == stats['receipts_total'] else f"{stats['receipts_fetched']} of {stats['receipts_total']}"
-        letters_count = stats['letters_total'] if stats['letters_fetched'] == stats['letters_total'] else f"{stats['letters_fetched']} of {stats['letters_total']}"
-        message = (
-            f"Kivra sync completed\n"
-            f"Receipts: {stats.get('receipts_stored', 0)} new items, {receipts_count} fetched\n"
-            f"Letters: {stats.get('letters_stored', 0)} new items, {letters_count} fetched"
-        )
+        summary_text = self._format_stats(stats)
+        message = f"Kivra sync completed\n{summary_text}"
         
         headers = {
             "Title": "Kivra sync completed",
@@ -152,21 +244,7 @@ class NtfyInteractionProvider(InteractionProvider):
             **self.ntfy_headers
         }
         
-        try:
-            response = requests.post(
-                f"{self.ntfy_server}/{self.ntfy_topic}",
-                data=message,
-                headers=headers
-            )
-            
-            if response.status_code != 200:
-                logging.error(f"Failed to send completion report via ntfy: {response.status_code}, {response.text}")
-                print("\nFailed to send completion report via ntfy.")
-            else:
-                print("\nCompletion report sent via ntfy.")
-        except Exception as e:
-            logging.error(f"Error sending completion report via ntfy: {str(e)}")
-            print("\nError sending completion report via ntfy.")
+        self._notify_pool.submit(self._post, message, headers, "completion report")
         
         # Also print to console
         print("\nAll done!")
@@ -185,21 +263,32 @@ class NtfyInteractionProvider(InteractionProvider):
             **self.ntfy_headers
         }
         
+        self._notify_pool.submit(self._post, message, headers, "authentication success")
+        
+        # Also print to console
+        print("BankID authentication successful! Starting data sync...")
+    
+    def _post(self, message, headers, description):
+        """
+        Post a notification to the ntfy topic. Runs on the notification worker.
+        
+        Args:
+            message (str): Notification body
+            headers (dict): Request headers
+            description (str): What is being sent, for log messages
+        """
         try:
-            response = requests.post(
-                f"{self.ntfy_server}/{self.ntfy_topic}",
+            response = self._session.post(
+                self._post_url,
                 data=message,
                 headers=headers
             )
             
             if response.status_code != 200:
-                logging.error(f"Failed to send authentication success via ntfy: {response.status_code}, {response.text}")
-                print("Failed to send authentication success via ntfy.")
+                logging.error(f"Failed to send {description} via ntfy: {response.status_code}, {response.text}")
+                print(f"Failed to send {description} via ntfy.")
             else:
-                print("Authentication success sent via ntfy.")
+                print(f"{description.capitalize()} sent via ntfy.")
         except Exception as e:
-            logging.error(f"Error sending authentication success via ntfy: {str(e)}")
-            print("Error sending authentication success via ntfy.")
-        
-        # Also print to console
-        print("BankID authentication successful! Starting data sync...")
+            logging.error(f"Error sending {description} via ntfy: {str(e)}")
+            print(f"Error sending {description} via ntfy.")
@@ -4,12 +4,21 @@
 import os
 import json
 import shutil
+import socket
+import asyncio
 import threading
+import signal
 import logging
 from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 from interaction.base import InteractionProvider
 
+# Interval between SSE heartbeats in seconds
+SSE_HEARTBEAT_INTERVAL = 30
+
+# Maximum bytes queued for a single SSE client before it is dropped as stalled
+SSE_MAX_BUFFERED = 1024 * 1024
+
 class WebInteractionProvider(InteractionProvider):
     """Web-based interaction provider that serves an HTTP interface."""
     
@@ -23,14 +32,26 @@ class WebInteractionProvider(InteractionProvider):
         """
         self.port = port
         self.host = host
-        self.sse_clients = []
+        # SSE stream writers, only touched from the SSE event loop thread
+        self.sse_clients = set()
+        self._sse_pending = []
+        self._sse_loop = None
         self.current_state = {"status": "idle", "message": "Ready to sync"}
+        # Encoded current_state, sent to clients as they connect
+        self._current_state_payload = self._encode_sse(self.current_state)
+        self._state_lock = threading.Lock()
         self.server = None
         self.server_thread = None
+        self.sse_thread = None
+        self._stop = threading.Event()
         self.callback = None
         self.static_dir = os.path.join(os.path.dirname(__file__), 'web_static')
         self.temp_dir = None
         self.qr_path = None
+        self.qr_bytes = None
+        # Static file cache: file path -> (mtime_ns, content bytes)
+        self._static_cache = {}
+        self._static_cache_lock = threading.Lock()
         
     @property
     def can_listen(self):
@@ -49,22 +70,145 @@ class WebInteractionProvider(InteractionProvider):
         Args:
             data (dict): Data to send as JSON
         """
-        message = f"data: {json.dumps(data)}\n\n"
+        payload = self._encode_sse(data)
         # Store current state
-        self.current_state.update(data)
+        with self._state_lock:
+            self.current_state.update(data)
+            self._current_state_payload = self._encode_sse(self.current_state)
         
-        # Send to all connected SSE clients
-        clients_to_remove = []
-        for client in self.sse_clients:
-            try:
-                client.wfile.write(message.encode())
-                client.wfile.flush()
-            except (BrokenPipeError, ConnectionResetError):
-                clients_to_remove.append(client)
+        self._broadcast(payload)
+    
+    @staticmethod
+    def _encode_sse(data):
+        """
+        Encode data as a Server-Sent Event message.
+        
+        Args:
+            data (dict): Data to send as JSON
+            
+        Returns:
+            bytes: Encoded SSE message
+        """
+        return f"data: {json.dumps(data, separators=(',', ':'))}\n\n".encode('utf-8')
+    
+    def _broadcast(self, payload):
+        """
+        Send an encoded SSE payload to every connected client.
+        
+        The write is handed to the SSE event loop, so a slow or disconnected
+        client never blocks the caller.
+        
+        Args:
+            payload (bytes): Encoded SSE message
+        """
+        if self._sse_loop is not None:
+            self._sse_loop.call_soon_threadsafe(self._queue_payload, payload)
+    
+    def _queue_payload(self, payload):
+        """
+        Queue a payload for the next flush. Runs on the SSE event loop.
+        
+        Messages queued within the same loop iteration are combined and
+        written to each client with a single send.
+        
+        Args:
+            payload (bytes): Encoded SSE message
+        """
+        self._sse_pending.append(payload)
+        if len(self._sse_pending) == 1:
+            self._sse_loop.call_soon(self._flush_pending)
+    
+    def _flush_pending(self):
+        """Write all queued payloads to the SSE clients. Runs on the SSE event loop."""
+        payload = b''.join(self._sse_pending)
+        self._sse_pending.clear()
+        self._write_all(payload)
+    
+    def _write_all(self, payload):
+        """
+        Write a payload to all SSE clients. Runs on the SSE event loop.
+        
+        Args:
+            payload (bytes): Encoded SSE message
+        """
+        for writer in list(self.sse_clients):
+            if writer.is_closing() or writer.transport.get_write_buffer_size() > SSE_MAX_BUFFERED:
+                self.sse_clients.discard(writer)
+                writer.close()
+                continue
+            writer.write(payload)
+    
+    def _run_sse_loop(self):
+        """Run the event loop that serves all SSE connections."""
+        asyncio.set_event_loop(self._sse_loop)
+        self._sse_loop.create_task(self._heartbeat())
+        self._sse_loop.run_forever()
+    
+    async def _heartbeat(self):
+        """Periodically send a heartbeat to all connected SSE clients."""
+        heartbeat = self._encode_sse({"heartbeat": True})
+        while True:
+            await asyncio.sleep(SSE_HEARTBEAT_INTERVAL)
+            self._queue_payload(heartbeat)
+    
+    async def _serve_sse_client(self, sock):
+        """
+        Keep an SSE connection open until the client disconnects.
+        
+        Args:
+            sock (socket.socket): Client socket, after the response headers were sent
+        """
+        reader, writer = await asyncio.open_connection(sock=sock)
         
-        # Remove disconnected clients
-        for client in clients_to_remove:
-            self.sse_clients.remove(client)
+        # Take the current state on the loop thread right before registering the
+        # client, so every later broadcast reaches it
+        writer.write(self._current_state_payload)
+        self.sse_clients.add(writer)
+        try:
+            # Clients never send anything on this connection; EOF means they left
+            while await reader.read(1024):
+                pass
+        except OSError:
+            pass
+        finally:
+            self.sse_clients.discard(writer)
+            writer.close()
+    
+    def _read_static(self, file_path):
+        """
+        Read a static file, reusing the cached bytes while its mtime is unchanged.
+        
+        Args:
+            file_path (str): Path to the static file
+            
+        Returns:
+            bytes: File content
+            
+        Raises:
+            FileNotFoundError: If the file does not exist
+        """
+        mtime = os.stat(file_path).st_mtime_ns
+        with self._static_cache_lock:
+            cached = self._static_cache.get(file_path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        
+        with open(file_path, 'rb') as f:
+            content = f.read()
+        
+        with self._static_cache_lock:
+            self._static_cache[file_path] = (mtime, content)
+        return content
+    
+    def _handle_signal(self, sig, frame):
+        """
+        Stop the web server on SIGINT/SIGTERM.
+        
+        Args:
+            sig (int): Signal number
+            frame (frame): Current stack frame
+        """
+        self._stop.set()
     
     def display_qr_code(self, qr_image_path):
         """
@@ -78,6 +222,8 @@ class WebInteractionProvider(InteractionProvider):
             if self.temp_dir:
                 web_qr_path = os.path.join(self.temp_dir, 'qr.png')
                 shutil.copy2(qr_image_path, web_qr_path)
+                with open(web_qr_path, 'rb') as f:
+                    self.qr_bytes = f.read()
                 self.qr_path = web_qr_path
                 
                 # Send SSE update
@@ -102,14 +248,8 @@ class WebInteractionProvider(InteractionProvider):
         Args:
             stats (dict): Statistics including receipts and letters counts
         """
-        receipts_count = stats['receipts_total'] if stats['receipts_fetched'] == stats['receipts_total'] else f"{stats['receipts_fetched']} of {stats['receipts_total']}"
-        letters_count = stats['letters_total'] if stats['letters_fetched'] == stats['letters_total'] else f"{stats['letters_fetched']} of {stats['letters_total']}"
-        
-        message = (
-            f"Sync completed successfully!\n"
-            f"Receipts: {stats.get('receipts_stored', 0)} new items, {receipts_count} fetched\n"
-            f"Letters: {stats.get('letters_stored', 0)} new items, {letters_count} fetched"
-        )
+        summary_text = self._format_stats(stats)
+        message = f"Sync completed successfully!\n{summary_text}"
         
         # Send SSE update
         self._send_sse_message({
@@ -128,6 +268,10 @@ class WebInteractionProvider(InteractionProvider):
         """
         Report that BankID authentication was successful and data sync is starting.
         """
+        # The QR code is single-use, stop serving it
+        self.qr_bytes = None
+        self.qr_path = None
+        
         self._send_sse_message({
             "status": "authenticated",
             "message": "BankID authentication successful! \n\nCheck terminal for detailed progress."
@@ -187,30 +331,25 @@ class WebInteractionProvider(InteractionProvider):
             def _serve_file(self, filename, content_type):
                 file_path = os.path.join(provider.static_dir, filename)
                 try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    
-                    self.send_response(200)
-                    self.send_header('Content-Type', content_type)
-                    self.send_header('Content-Length', str(len(content.encode())))
-                    self.end_headers()
-                    self.wfile.write(content.encode())
+                    content = provider._read_static(file_path)
                 except FileNotFoundError:
                     self._send_404()
+                    return
+                
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
             
             def _serve_qr(self):
-                if provider.qr_path and os.path.exists(provider.qr_path):
-                    try:
-                        with open(provider.qr_path, 'rb') as f:
-                            content = f.read()
-                        
-                        self.send_response(200)
-                        self.send_header('Content-Type', 'image/png')
-                        self.send_header('Content-Length', str(len(content)))
-                        self.end_headers()
-                        self.wfile.write(content)
-                    except Exception:
-                        self._send_404()
+                qr_bytes = provider.qr_bytes
+                if qr_bytes is not None:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'image/png')
+                    self.send_header('Content-Length', str(len(qr_bytes)))
+                    self.end_headers()
+                    self.wfile.write(qr_bytes)
                 else:
                     self._send_404()
             
@@ -222,30 +361,14 @@ class WebInteractionProvider(InteractionProvider):
                 self.send_header('Access-Control-Allow-Origin', '*')
                 self.end_headers()
                 
-                # Add client to SSE clients list
-                provider.sse_clients.append(self)
-                
-                # Send current state immediately
-                initial_message = f"data: {json.dumps(provider.current_state)}\n\n"
-                try:
-                    self.wfile.write(initial_message.encode())
-                    self.wfile.flush()
-                except:
-                    pass
-                
-                # Keep connection alive (client will be removed when connection breaks)
-                try:
-                    while True:
-                        # Send heartbeat every 30 seconds
-                        import time
-                        time.sleep(30)
-                        heartbeat = "data: {\"heartbeat\": true}\n\n"
-                        self.wfile.write(heartbeat.encode())
-                        self.wfile.flush()
-                except:
-                    # Connection closed
-                    if self in provider.sse_clients:
-                        provider.sse_clients.remove(self)
+                # Hand the connection over to the SSE event loop so it doesn't
+                # occupy a server thread for as long as the client stays connected
+                self.close_connection = True
+                sock = socket.socket(fileno=self.connection.detach())
+                asyncio.run_coroutine_threadsafe(
+                    provider._serve_sse_client(sock),
+                    provider._sse_loop
+                )
             
             def _handle_trigger(self):
                 # Send immediate response FIRST to prevent blocking
@@ -282,6 +405,12 @@ class WebInteractionProvider(InteractionProvider):
                 self.end_headers()
                 self.wfile.write(b'Not Found')
         
+        # Start the event loop serving SSE connections
+        self._sse_loop = asyncio.new_event_loop()
+        self.sse_thread = threading.Thread(target=self._run_sse_loop)
+        self.sse_thread.daemon = True
+        self.sse_thread.start()
+        
         # Start HTTP server with threading support
         try:
             self.server = ThreadingHTTPServer((self.host, self.port), WebRequestHandler)
@@ -294,15 +423,19 @@ class WebInteractionProvider(InteractionProvider):
             
             print(f"Web interface ready at http://{self.host}:{self.port}")
             
-            # Keep main thread alive
+            # Park the main thread until a signal asks us to stop
+            if threading.current_thread() is threading.main_thread():
+                signal.signal(signal.SIGINT, self._handle_signal)
+                signal.signal(signal.SIGTERM, self._handle_signal)
             try:
-                while True:
-                    import time
-                    time.sleep(1)
+                self._stop.wait()
             except KeyboardInterrupt:
+                pass
+            finally:
                 print("\nShutting down web server...")
                 self.server.shutdown()
                 self.server.server_close()
+                self._sse_loop.call_soon_threadsafe(self._sse_loop.stop)
                 
         except Exception as e:
             logging.error(f"Failed to start web server: {str(e)}")
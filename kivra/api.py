@@ -2,49 +2,204 @@
 # -*- coding: utf-8 -*-
 
 import requests
+from requests.adapters import HTTPAdapter
 import logging
+import json
+import os
 import sys
+import threading
+from utils.helpers import json_loads, json_dumps
 
 class KivraApiClient:
     """Client for interacting with Kivra's API."""
     
-    def __init__(self, access_token, actor_key):
+    def __init__(self, access_token, actor_key, session=None, cache_dir=None, pool_size=20):
         """
         Initialize the Kivra API client.
         
         Args:
             access_token (str): OAuth access token
             actor_key (str): Kivra user ID
+            session (requests.Session, optional): Session to reuse, e.g. the one used
+                for authentication so its open connections are kept. A new session
+                is created if not given.
+            cache_dir (str, optional): Directory to persist the GraphQL ETag cache in.
+                The cache is kept in memory only if not given.
+            pool_size (int, optional): Connection pool size of the session created when
+                none is given. Defaults to 20.
         """
         self.access_token = access_token
         self.actor_key = actor_key
         self.graphql_url = "https://bff.kivra.com/graphql"
-        self.session = requests.Session()
-    
-    def get_headers(self):
-        """
-        Get common headers for API requests.
         
-        Returns:
-            dict: Headers for API requests
-        """
-        return {
-            'Content-Type': 'application/json',
+        # Cache of GraphQL responses that came with an ETag, for conditional requests
+        self.cache_path = os.path.join(cache_dir, 'graphql_cache.json') if cache_dir else None
+        self._etag_cache = self._load_etag_cache()
+        self._etag_cache_lock = threading.Lock()
+        
+        # Cache entries used since the cache was last saved, and the key prefixes
+        # they belong to, so entries left over from older listings can be dropped
+        self._etag_cache_used = set()
+        self._etag_cache_used_prefixes = set()
+        self._etag_cache_dirty = False
+        
+        # Cleared if the server turns out not to support persisted queries
+        self._persisted_queries = True
+        
+        # Encoded request bodies up to the variables, see _graphql_body()
+        self._body_prefixes = {}
+        
+        if session is not None:
+            self.session = session
+        else:
+            self.session = requests.Session()
+            
+            # Size the connection pool for concurrent letter/receipt processing so
+            # every worker keeps its own keep-alive connection. With pool_block the
+            # pool is also a hard limit, extra workers wait for a free connection
+            # instead of opening short-lived ones.
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0, pool_block=True)
+            self.session.mount('https://', adapter)
+        
+        # Headers shared by all requests are set once on the session, the
+        # per-request dicts below only carry what differs between endpoints
+        self.session.headers.update({
             'Accept': 'application/json',
             'Origin': 'https://inbox.kivra.com',
             'Referer': 'https://inbox.kivra.com/',
-            'Authorization': f'Bearer {self.access_token}',
-            'X-Actor-Key': self.actor_key,
+            'X-Actor-Key': actor_key,
             'X-Actor-Type': 'user',
-            'X-Session-Actor': f'user_{self.actor_key}',
+            'X-Session-Actor': f'user_{actor_key}',
             'X-Kivra-Environment': 'production',
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/132.0.0.0 Safari/537.36',
-            'Accept-Language': 'sv',
-            'Cache-Control': 'no-cache',
-            'Pragma': 'no-cache'
-        }
+            'Accept-Language': 'sv'
+        })
+        self._graphql_headers = {'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'}
+        self._content_headers = {'Authorization': f'token {access_token}'}
+        self._file_headers = {'Authorization': f'token {access_token}', 'Accept': '*/*'}
+        self._pdf_headers = {'Authorization': f'token {access_token}', 'Accept': 'application/pdf'}
+    
+    def _load_etag_cache(self):
+        """
+        Load the persisted GraphQL ETag cache.
+        
+        Returns:
+            dict: Cache entries keyed by query, each with 'etag' and 'data'
+        """
+        if not self.cache_path:
+            return {}
+        
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logging.warning("Ignoring unreadable GraphQL cache %s: %s", self.cache_path, e)
+            return {}
+    
+    def save_etag_cache(self):
+        """
+        Persist the GraphQL ETag cache if it changed.
+        
+        Call this once a listing has been fetched. Of the queries made since the
+        last save, only the entries of the latest responses are kept, older ones
+        with the same cache key are dropped so the file doesn't grow with every
+        cursor or page size ever used. The file holds letter data, so it is only
+        readable by the user.
+        """
+        with self._etag_cache_lock:
+            if not self._etag_cache_dirty:
+                return
+            
+            for key in list(self._etag_cache):
+                if key not in self._etag_cache_used and key.startswith(tuple(self._etag_cache_used_prefixes)):
+                    del self._etag_cache[key]
+            self._etag_cache_used.clear()
+            self._etag_cache_used_prefixes.clear()
+            self._etag_cache_dirty = False
+            
+            if not self.cache_path:
+                return
+            
+            try:
+                tmp_path = f"{self.cache_path}.tmp"
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                os.fchmod(fd, 0o600)
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(self._etag_cache, f, ensure_ascii=False)
+                os.replace(tmp_path, self.cache_path)
+            except Exception as e:
+                logging.warning("Failed to save GraphQL cache: %s", e)
     
-    def graphql_query(self, operation_name, query, variables):
+    def _get_persisted_query_error(self, response):
+        """
+        Check whether a persisted query request failed.
+        
+        Args:
+            response (requests.Response): Response to a request sent with only the query hash
+            
+        Returns:
+            str: None if the request succeeded or failed for an unrelated reason,
+                'not_found' if the server doesn't know the hash yet, 'failed' if the
+                server doesn't support persisted queries
+        """
+        # Avoid parsing successful responses twice
+        if response.status_code == 200 and b'"errors"' not in response.content:
+            return None
+        
+        try:
+            errors = json_loads(response.content).get('errors') or []
+        except Exception:
+            errors = []
+        
+        if response.status_code == 200 and not errors:
+            return None
+        
+        if self._is_persisted_query_not_found({'errors': errors}):
+            return 'not_found'
+        
+        for error in errors:
+            if not isinstance(error, dict):
+                continue
+            code = (error.get('extensions') or {}).get('code')
+            if code == 'PERSISTED_QUERY_NOT_SUPPORTED' or error.get('message') == 'PersistedQueryNotSupported':
+                return 'failed'
+        
+        # Anything else (expired token, server error, field errors) goes through
+        # the normal error handling
+        return None
+    
+    def _graphql_body(self, operation_name, query, variables, query_hash=None):
+        """
+        Encode a GraphQL request body.
+        
+        Everything but the variables is the same for every request of an operation,
+        so that part is encoded once and reused.
+        
+        Args:
+            operation_name (str): Name of the GraphQL operation
+            query (str): GraphQL query string, None to send only the persisted query hash
+            variables (dict): Variables for the query
+            query_hash (str, optional): SHA-256 of the query to send as a persisted query
+            
+        Returns:
+            bytes: JSON request body
+        """
+        prefix_key = (operation_name, query, query_hash)
+        prefix = self._body_prefixes.get(prefix_key)
+        if prefix is None:
+            prefix = b'{"operationName":' + json_dumps(operation_name)
+            if query is not None:
+                prefix += b',"query":' + json_dumps(query)
+            if query_hash is not None:
+                prefix += b',"extensions":' + json_dumps({"persistedQuery": {"version": 1, "sha256Hash": query_hash}})
+            prefix += b',"variables":'
+            self._body_prefixes[prefix_key] = prefix
+        
+        return prefix + json_dumps(variables) + b'}'
+    
+    def graphql_query(self, operation_name, query, variables, cache_key=None, query_hash=None):
         """
         Execute a GraphQL query.
         
@@ -52,36 +207,184 @@ class KivraApiClient:
             operation_name (str): Name of the GraphQL operation
             query (str): GraphQL query string
             variables (dict): Variables for the query
+            cache_key (str, optional): Enables conditional requests for this query.
+                If the server sent an ETag for a previous response with the same key
+                and variables, the request carries If-None-Match and a 304 response
+                returns the cached data.
+            query_hash (str, optional): SHA-256 of the query. If given, the query is sent
+                as an automatic persisted query with only the hash, falling back to the
+                full query text if the server doesn't know it.
             
         Returns:
             dict: Query response data
         """
-        payload = {
-            "operationName": operation_name,
-            "query": query,
-            "variables": variables
-        }
+        persisted = query_hash is not None and self._persisted_queries
+        if persisted:
+            body = self._graphql_body(operation_name, None, variables, query_hash)
+        else:
+            body = self._graphql_body(operation_name, query, variables)
         
-        logging.debug(f"GraphQL query: {operation_name}")
-        logging.debug(f"Variables: {variables}")
+        logging.debug("GraphQL query: %s", operation_name)
+        logging.debug("Variables: %s", variables)
+        
+        headers = self._graphql_headers
+        cached = None
+        if cache_key:
+            cache_prefix = f"{self.actor_key}:{cache_key}:"
+            cache_key = f"{cache_prefix}{json.dumps(variables, sort_keys=True)}"
+            cached = self._etag_cache.get(cache_key)
+            if cached:
+                headers = {**headers, 'If-None-Match': cached['etag']}
         
         response = self.session.post(
             self.graphql_url,
-            json=payload,
-            headers=self.get_headers()
+            data=body,
+            headers=headers
         )
         
+        if persisted and response.status_code != 304:
+            error = self._get_persisted_query_error(response)
+            if error is not None:
+                if error == 'not_found':
+                    # Send the query along with its hash so the server registers it
+                    logging.debug("Persisted query %s not found, sending the full query", operation_name)
+                    body = self._graphql_body(operation_name, query, variables, query_hash)
+                else:
+                    logging.info("GraphQL server doesn't support persisted queries, sending full queries")
+                    self._persisted_queries = False
+                    body = self._graphql_body(operation_name, query, variables)
+                
+                response = self.session.post(
+                    self.graphql_url,
+                    data=body,
+                    headers=headers
+                )
+        
+        if cached and response.status_code == 304:
+            logging.debug("GraphQL query %s not modified, using cached response", operation_name)
+            with self._etag_cache_lock:
+                self._etag_cache_used.add(cache_key)
+                self._etag_cache_used_prefixes.add(cache_prefix)
+            return cached['data']
+        
         if response.status_code != 200:
-            logging.error(f"GraphQL error: {response.status_code}, {response.text}")
+            logging.error("GraphQL error: %s, %s", response.status_code, response.text)
             raise Exception(f"GraphQL query failed: {response.status_code}")
             
-        data = response.json()
+        data = json_loads(response.content)
         if 'errors' in data:
-            logging.error(f"GraphQL errors: {data['errors']}")
+            logging.error("GraphQL errors: %s", data['errors'])
             raise Exception(f"GraphQL query returned errors: {data['errors']}")
+        
+        etag = response.headers.get('ETag')
+        if cache_key and etag:
+            with self._etag_cache_lock:
+                self._etag_cache[cache_key] = {'etag': etag, 'data': data}
+                self._etag_cache_used.add(cache_key)
+                self._etag_cache_used_prefixes.add(cache_prefix)
+                self._etag_cache_dirty = True
+            
+        return data
+    
+    def graphql_query_batch(self, operation_name, query, variables_list, query_hash=None):
+        """
+        Execute a GraphQL query for several sets of variables in a single request,
+        as an Apollo style batch with a JSON array body.
+        
+        Args:
+            operation_name (str): Name of the GraphQL operation
+            query (str): GraphQL query string
+            variables_list (list): Variables for each query in the batch
+            query_hash (str, optional): SHA-256 of the query. If given, the queries are sent
+                as automatic persisted queries with only the hash, and the batch is sent
+                again with the full query text if the server doesn't know it.
+            
+        Returns:
+            list: One response dict per set of variables, in the same order. Errors in
+                single queries are left in their response dicts. None if the server
+                rejects batched requests.
+                
+        Raises:
+            Exception: If the request fails for any other reason
+        """
+        persisted = query_hash is not None and self._persisted_queries
+        
+        logging.debug("GraphQL batch of %s %s queries", len(variables_list), operation_name)
+        
+        if persisted:
+            data = self._post_graphql_batch(operation_name, None, variables_list, query_hash)
+        else:
+            data = self._post_graphql_batch(operation_name, query, variables_list)
+        
+        if persisted and data is not None and any(self._is_persisted_query_not_found(result) for result in data):
+            # Send the query along with its hash so the server registers it
+            logging.debug("Persisted query %s not found, sending the full query", operation_name)
+            data = self._post_graphql_batch(operation_name, query, variables_list, query_hash)
+        
+        return data
+    
+    def _post_graphql_batch(self, operation_name, query, variables_list, query_hash=None):
+        """
+        Send a batch of GraphQL queries.
+        
+        Args:
+            operation_name (str): Name of the GraphQL operation
+            query (str): GraphQL query string, None to send only the persisted query hash
+            variables_list (list): Variables for each query in the batch
+            query_hash (str, optional): SHA-256 of the query to send as a persisted query
             
+        Returns:
+            list: One response dict per set of variables, None if the server
+                rejects batched requests
+        """
+        body = b'[' + b','.join(
+            self._graphql_body(operation_name, query, variables, query_hash)
+            for variables in variables_list
+        ) + b']'
+        
+        response = self.session.post(
+            self.graphql_url,
+            data=body,
+            headers=self._graphql_headers
+        )
+        
+        # A server without batching support rejects the array body outright or
+        # answers it with a single result
+        if response.status_code in (400, 422):
+            logging.debug("GraphQL batch rejected: %s, %s", response.status_code, response.text)
+            return None
+        
+        if response.status_code != 200:
+            logging.debug("GraphQL batch error: %s, %s", response.status_code, response.text)
+            raise Exception(f"GraphQL batch query failed: {response.status_code}")
+        
+        data = json_loads(response.content)
+        if not isinstance(data, list) or len(data) != len(variables_list):
+            logging.debug("GraphQL batch answered with a non-batch response")
+            return None
+        
         return data
     
+    def _is_persisted_query_not_found(self, result):
+        """
+        Check whether a single query result says the persisted query hash is unknown.
+        
+        Args:
+            result (dict): Result of one query
+            
+        Returns:
+            bool: True if the server doesn't know the query hash
+        """
+        if not isinstance(result, dict):
+            return False
+        
+        for error in result.get('errors') or []:
+            code = (error.get('extensions') or {}).get('code')
+            if code == 'PERSISTED_QUERY_NOT_FOUND' or error.get('message') == 'PersistedQueryNotFound':
+                return True
+        
+        return False
+    
     def get_pdf(self, url):
         """
         Get a PDF document from Kivra.
@@ -92,23 +395,39 @@ class KivraApiClient:
         Returns:
             bytes: PDF content
         """
-        headers = {
-            'Authorization': f'token {self.access_token}',
-            'Accept': 'application/pdf'
-        }
+        headers = self._pdf_headers
         
         response = self.session.get(url, headers=headers)
         
         if response.status_code != 200:
-            logging.error(f"Failed to get PDF. Status: {response.status_code}")
-            logging.error(f"URL: {url}")
-            logging.error(f"Headers: {headers}")
-            logging.error(f"Response headers: {dict(response.headers)}")
-            logging.error(f"Response body: {response.text}")
+            logging.error("Failed to get PDF. Status: %s", response.status_code)
+            logging.error("URL: %s", url)
+            logging.error("Headers: %s", headers)
+            logging.error("Response headers: %s", dict(response.headers))
+            logging.error("Response body: %s", response.text)
             raise Exception(f"Failed to get PDF: {response.status_code}")
         
         return response.content
     
+    def get_pdf_stream(self, url, out_fp, chunk_size=65536):
+        """
+        Stream a PDF document from Kivra into a file object.
+        
+        Args:
+            url (str): URL to the PDF document
+            out_fp (file): Binary file object to write the PDF to
+            chunk_size (int, optional): Size of the chunks to read. Defaults to 64 KiB.
+        """
+        with self.session.get(url, headers=self._pdf_headers, stream=True) as response:
+            if response.status_code != 200:
+                logging.error("Failed to get PDF. Status: %s", response.status_code)
+                logging.error("URL: %s", url)
+                logging.error("Response: %s", response.text)
+                raise Exception(f"Failed to get PDF: {response.status_code}")
+            
+            for chunk in response.iter_content(chunk_size):
+                out_fp.write(chunk)
+    
     def get_content_details(self, content_key):
         """
         Get details for a content item (letter).
@@ -120,20 +439,15 @@ class KivraApiClient:
             dict: Content details
         """
         content_url = f"https://app.api.kivra.com/v1/content/{content_key}"
-        headers = {
-            'Authorization': f'token {self.access_token}',
-            'Accept': 'application/json'
-        }
-        
-        response = self.session.get(content_url, headers=headers)
+        response = self.session.get(content_url, headers=self._content_headers)
         
         if response.status_code != 200:
-            logging.error(f"Failed to get content details. Status: {response.status_code}")
-            logging.error(f"URL: {content_url}")
-            logging.error(f"Response: {response.text}")
+            logging.error("Failed to get content details. Status: %s", response.status_code)
+            logging.error("URL: %s", content_url)
+            logging.error("Response: %s", response.text)
             raise Exception(f"Failed to get content details: {response.status_code}")
         
-        return response.json()
+        return json_loads(response.content)
     
     def get_content_file(self, content_key, file_key):
         """
@@ -147,16 +461,34 @@ class KivraApiClient:
             bytes: File content
         """
         file_url = f"https://app.api.kivra.com/v1/content/{content_key}/file/{file_key}/raw"
-        headers = {
-            'Authorization': f'token {self.access_token}'
-        }
-        
-        response = self.session.get(file_url, headers=headers)
+        response = self.session.get(file_url, headers=self._file_headers)
         
         if response.status_code != 200:
-            logging.error(f"Failed to get content file. Status: {response.status_code}")
-            logging.error(f"URL: {file_url}")
-            logging.error(f"Response: {response.text}")
+            logging.error("Failed to get content file. Status: %s", response.status_code)
+            logging.error("URL: %s", file_url)
+            logging.error("Response: %s", response.text)
             raise Exception(f"Failed to get content file: {response.status_code}")
         
         return response.content
+    
+    def get_content_file_stream(self, content_key, file_key, out_fp, chunk_size=65536):
+        """
+        Stream a file from a content item (letter) into a file object.
+        
+        Args:
+            content_key (str): Content key
+            file_key (str): File key
+            out_fp (file): Binary file object to write the content to
+            chunk_size (int, optional): Size of the chunks to read. Defaults to 64 KiB.
+        """
+        file_url = f"https://app.api.kivra.com/v1/content/{content_key}/file/{file_key}/raw"
+        
+        with self.session.get(file_url, headers=self._file_headers, stream=True) as response:
+            if response.status_code != 200:
+                logging.error("Failed to get content file. Status: %s", response.status_code)
+                logging.error("URL: %s", file_url)
+                logging.error("Response: %s", response.text)
+                raise Exception(f"Failed to get content file: {response.status_code}")
+            
+            for chunk in response.iter_content(chunk_size):
+                out_fp.write(chunk)
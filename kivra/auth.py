@@ -2,30 +2,44 @@
 # -*- coding: utf-8 -*-
 
 import requests
+from requests.adapters import HTTPAdapter
 import hashlib
 import base64
 import secrets
+import random
 import time
 import qrcode
 import os
 import logging
-import json
 import sys
+from utils.helpers import json_loads
+
+# BankID status polling starts at the minimum interval and backs off to the
+# maximum, a server supplied Retry-After takes precedence
+POLL_MIN_INTERVAL = 1.0
+POLL_MAX_INTERVAL = 3.0
+
+# Seconds the poll endpoint is asked to hold the request until the status changes
+POLL_WAIT = 30
 
 class KivraAuth:
     """Class for handling Kivra authentication via BankID."""
     
-    def __init__(self, temp_dir, interaction_provider):
+    def __init__(self, temp_dir, interaction_provider, pool_size=20):
         """
         Initialize the Kivra authentication handler.
         
         Args:
             temp_dir (str): Directory for temporary files like QR codes
             interaction_provider (InteractionProvider): Provider for user interaction
+            pool_size (int, optional): Number of connections the session keeps open.
+                                       Should cover the number of concurrent workers
+                                       that reuse the session. Defaults to 20.
         """
         self.temp_dir = temp_dir
         self.interaction_provider = interaction_provider
         self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0, pool_block=True))
         self.client_id = "14085255171411300228f14dceae786da5a00285fe"
         
     def authenticate(self, ssn):
@@ -67,6 +81,12 @@ class KivraAuth:
         qr.add_data(qr_code)
         qr.make(fit=True)
         
+        if self.interaction_provider.supports_ascii_qr:
+            # Print the QR code in the terminal, no image has to be rendered and saved
+            qr.print_ascii(tty=sys.stdout.isatty())
+            print("\nQR-kod visas nu. Skanna den med BankID-appen.")
+            return self._poll_for_auth(next_poll_url, auth_code, code_verifier)
+        
         # Create and save QR code as a temporary image
         img = qr.make_image(fill_color="black", back_color="white")
         temp_path = os.path.join(self.temp_dir, "kivra_qr.png")
@@ -128,10 +148,10 @@ class KivraAuth:
                              })
         
         if r.status_code not in [201, 202]:
-            logging.error(f"OAuth2 authorization failed. Status: {r.status_code}, Response: {r.text}")
+            logging.error("OAuth2 authorization failed. Status: %s, Response: %s", r.status_code, r.text)
             sys.exit("Could not initialize OAuth2")
         
-        return r.json()
+        return json_loads(r.content)
     
     
     def _poll_for_auth(self, next_poll_url, auth_code, code_verifier):
@@ -148,10 +168,44 @@ class KivraAuth:
         """
         print("\nWaiting for BankID authentication...")
         
+        attempt = 0
+        retry_after = None
+        long_poll = True
+        elapsed = 0.0
+        
         while True:
-            time.sleep(5)
-            poll_response = self.session.get(f"https://app.api.kivra.com{next_poll_url}")
-            poll_data = poll_response.json()
+            if retry_after is not None:
+                delay = retry_after
+            else:
+                delay = min(POLL_MAX_INTERVAL, POLL_MIN_INTERVAL * 1.5 ** attempt) + random.uniform(0, 0.3)
+            
+            # Time spent waiting in a long-polled request counts towards the delay
+            time.sleep(max(0.0, delay - elapsed))
+            attempt += 1
+            
+            poll_url = f"https://app.api.kivra.com{next_poll_url}"
+            started = time.monotonic()
+            if long_poll:
+                try:
+                    poll_response = self.session.get(poll_url, params={'wait': POLL_WAIT}, timeout=POLL_WAIT + 5)
+                except requests.exceptions.ReadTimeout:
+                    # The status didn't change while the server held the request
+                    elapsed = time.monotonic() - started
+                    continue
+                
+                if 400 <= poll_response.status_code < 500:
+                    logging.info("Poll endpoint doesn't accept long polling, polling at intervals")
+                    long_poll = False
+            
+            if not long_poll:
+                poll_response = self.session.get(poll_url)
+            elapsed = time.monotonic() - started
+            
+            retry_after = self._get_retry_after(poll_response)
+            poll_data = json_loads(poll_response.content)
+            
+            # Follow the poll URL if the server hands out a new one
+            next_poll_url = poll_data.get('next_poll_url') or next_poll_url
             
             if poll_data.get('status') == 'complete':
                 print("\nBankID authentication successful!")
@@ -175,10 +229,10 @@ class KivraAuth:
                                                  headers={'Content-Type': 'application/json'})
                 
                 if token_response.status_code != 200:
-                    logging.error(f"Failed to fetch token. Status: {token_response.status_code}, Response: {token_response.text}")
+                    logging.error("Failed to fetch token. Status: %s, Response: %s", token_response.status_code, token_response.text)
                     sys.exit("Token retrieval failed")
                 
-                token_info = token_response.json()
+                token_info = json_loads(token_response.content)
                 access_token = token_info.get('access_token')
                 id_token = token_info.get('id_token')
                 
@@ -188,16 +242,16 @@ class KivraAuth:
                     logging.error("Invalid id_token structure")
                     sys.exit("Could not parse id_token")
                 
-                # Decode base64
-                padding = '=' * (4 - len(id_token_parts[1]) % 4)
-                jwt_payload = base64.b64decode(id_token_parts[1] + padding)
-                jwt_data = json.loads(jwt_payload)
+                # Decode the payload, JWTs use unpadded base64url
+                payload_segment = id_token_parts[1]
+                jwt_payload = base64.urlsafe_b64decode(payload_segment + '=' * (-len(payload_segment) % 4))
+                jwt_data = json_loads(jwt_payload)
                 
                 # Get kivra_user_id from JWT
                 actor_key = jwt_data.get('kivra_user_id')
                 
                 if not actor_key:
-                    logging.error(f"Could not find kivra_user_id in token: {jwt_data}")
+                    logging.error("Could not find kivra_user_id in token: %s", jwt_data)
                     sys.exit("Missing kivra_user_id")
                 
                 # Return token information
@@ -210,5 +264,24 @@ class KivraAuth:
             elif poll_data.get('status') == 'pending':
                 print(".", end="", flush=True)  # Show progress
             else:
-                logging.error(f"Error during polling. Status: {poll_data.get('status')}, Response: {poll_data}")
+                logging.error("Error during polling. Status: %s, Response: %s", poll_data.get('status'), poll_data)
                 sys.exit("BankID authentication failed")
+    
+    def _get_retry_after(self, response):
+        """
+        Get the Retry-After delay from a response.
+        
+        Args:
+            response (requests.Response): Poll response
+            
+        Returns:
+            float: Delay in seconds, or None if not set or not given in seconds
+        """
+        retry_after = response.headers.get('Retry-After')
+        if not retry_after:
+            return None
+        
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            return None
@@ -2,22 +2,41 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from utils.helpers import format_date
-from kivra.models import LETTERS_QUERY, KivraLetter
+from utils.progress import ProgressReporter
+from kivra.models import LETTERS_QUERY, LETTERS_QUERY_HASH, KivraLetter
+
+# Letters requested for the first page. Once the total is known the rest is
+# requested in as few pages as possible, up to the maximum page size.
+LETTERS_PAGE_SIZE = 100
+LETTERS_MAX_PAGE_SIZE = 1000
+
+@dataclass(slots=True)
+class _LetterRow:
+    """The fields of a letter list entry used while processing it."""
+    key: str
+    received_at: str
+    sender_name: str
+    raw: dict
 
 class LetterFetcher:
     """Class for fetching letters from Kivra."""
     
-    def __init__(self, api_client, document_store):
+    def __init__(self, api_client, document_store, max_workers=10):
         """
         Initialize the letter fetcher.
         
         Args:
             api_client (KivraApiClient): Kivra API client
             document_store (DocumentStoreProvider): Document store provider
+            max_workers (int, optional): Number of letters to process concurrently. Defaults to 10.
         """
         self.api_client = api_client
         self.document_store = document_store
+        self.max_workers = max_workers
     
     def fetch_letters(self, max_count=None):
         """
@@ -35,20 +54,43 @@ class LetterFetcher:
             # Fetch all letters with pagination
             all_letters = []
             after = None
+            take = LETTERS_PAGE_SIZE
+            large_pages = True
+            total_reported = None
+            stopped_early = False
             
             while True:
                 variables = {
                     "after": after,
                     "filter": "inbox",
                     "senderKey": None,
-                    "take": 100  # Increase per-page count for fewer requests
+                    "take": take
                 }
                 
-                data = self.api_client.graphql_query("ContentList", LETTERS_QUERY, variables)
+                try:
+                    data = self.api_client.graphql_query(
+                        "ContentList", LETTERS_QUERY, variables,
+                        cache_key="letters", query_hash=LETTERS_QUERY_HASH
+                    )
+                except Exception:
+                    if take <= LETTERS_PAGE_SIZE:
+                        raise
+                    # The pages are cursor based so they can't be requested in
+                    # parallel, fall back to regular pages if a large one is refused
+                    logging.info("Fetching %s letters at once failed, retrying with pages of %s", take, LETTERS_PAGE_SIZE)
+                    take = LETTERS_PAGE_SIZE
+                    large_pages = False
+                    continue
                 
                 page_content = data.get('data', {}).get('contents', {})
                 page_letters = page_content.get('list', [])
                 all_letters.extend(page_letters)
+                total_reported = page_content.get('total', total_reported)
+                
+                # Stop paginating once there are enough letters to process
+                if max_count is not None and len(all_letters) >= max_count:
+                    stopped_early = page_content.get('existsMore', False)
+                    break
                 
                 exists_more = page_content.get('existsMore', False)
                 if not exists_more or not page_letters:
@@ -57,26 +99,62 @@ class LetterFetcher:
                 # Use the last letter's key as 'after' for the next page
                 after = page_letters[-1]['key']
                 print(f"Fetched {len(all_letters)} letters of {page_content.get('total', '?')}...")
+                
+                # Ask for the remaining letters in a single page when possible
+                if large_pages and isinstance(total_reported, int):
+                    remaining = total_reported - len(all_letters)
+                    if max_count is not None:
+                        remaining = min(remaining, max_count - len(all_letters))
+                    take = max(LETTERS_PAGE_SIZE, min(remaining, LETTERS_MAX_PAGE_SIZE))
+            
+            # Write the responses kept for conditional requests once per listing
+            self.api_client.save_etag_cache()
             
-            total_letters = len(all_letters)
+            # The full list wasn't fetched if pagination stopped at max_count
+            if stopped_early and isinstance(total_reported, int):
+                total_letters = total_reported
+            else:
+                total_letters = len(all_letters)
             print(f"\nFound a total of {total_letters} letters")
             
-            # Report letter list for storage
-            self.document_store.report_listing('letters', all_letters)
+            # Report letter list for storage, unless only part of it was fetched so
+            # a complete listing from an earlier run isn't overwritten
+            if stopped_early:
+                logging.info("Not saving the letter listing, only %s of %s letters were listed", len(all_letters), total_letters)
+            else:
+                self.document_store.report_listing('letters', all_letters)
             
             # Limit the number of letters if max_count is set
             if max_count is not None:
-                print(f"\nLimiting to {max_count} letters (of {len(all_letters)} available)")
+                print(f"\nLimiting to {max_count} letters (of {total_letters} available)")
                 all_letters = all_letters[:max_count]
             
-            # Add a counter for stored letters
-            letters_stored = 0
+            # List the letters already stored once instead of checking them one by one
+            existing_keys = self.document_store.list_existing_keys('letter')
             
-            # Process each letter
+            # Pick out the fields needed for processing once per letter
+            letter_rows = [
+                _LetterRow(
+                    letter_data.get('key'),
+                    letter_data.get('receivedAt', 'unknown_date'),
+                    letter_data.get('sender', {}).get('name', 'unknown_sender'),
+                    letter_data
+                )
+                for letter_data in all_letters
+            ]
+            
+            # Process the letters concurrently, each one is bound by network round trips
             print("\nFetching PDF and details for each letter...")
-            for letter_data in all_letters:
-                # Pass the counter to _process_letter and get the updated value
-                letters_stored = self._process_letter(letter_data, letters_stored)
+            progress = ProgressReporter(len(letter_rows), "Letters")
+            
+            def process(row):
+                stored = self._process_letter(row, existing_keys)
+                progress.update(stored)
+                return stored
+            
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                letters_stored = sum(executor.map(process, letter_rows))
+            progress.close()
                 
             print("\nFinished processing all letters!")
             
@@ -88,60 +166,67 @@ class LetterFetcher:
             }
             
         except Exception as e:
-            logging.error(f"Error fetching letters: {str(e)}")
+            logging.error("Error fetching letters: %s", e)
             raise
     
-    def _process_letter(self, letter_data, letters_stored):
+    def _process_letter(self, row, existing_keys=None):
         """
         Process a single letter.
         
         Args:
-            letter_data (dict): Letter data from the list
-            letters_stored (int): Counter for stored letters
+            row (_LetterRow): Letter from the list
+            existing_keys (set, optional): Keys of letters already in the document store,
+                                           the store is asked per letter if not given
             
         Returns:
-            int: Updated counter for stored letters
+            int: 1 if the letter was stored, 0 otherwise
         """
-        letter_key = letter_data.get('key')
+        letter_key = row.key
         if not letter_key:
             logging.warning("Letter missing key, skipping")
-            return
+            return 0
         
         # Create metadata based on date and sender
-        date = format_date(letter_data.get('receivedAt', 'unknown_date'))
-        sender = letter_data.get('sender', {}).get('name', 'unknown_sender')
+        date = format_date(row.received_at)
+        sender = row.sender_name
         
         # Create letter object
         letter = KivraLetter(letter_key, date, sender)
         
         # Check if JSON metadata already exists
         json_metadata = letter.get_metadata()
-        if self.document_store.exists(json_metadata):
-            print(f"Skipping letter {letter_key} - already fetched")
-            return letters_stored
+        if existing_keys is not None:
+            already_fetched = letter_key in existing_keys
+        else:
+            already_fetched = self.document_store.exists(json_metadata)
+        if already_fetched:
+            logging.debug("Skipping letter %s - already fetched", letter_key)
+            return 0
         
-        print(f"\nProcessing letter: {letter_key}")
+        logging.debug("Processing letter: %s", letter_key)
         
         try:
             # 1. Fetch detailed letter information
             content_data = self.api_client.get_content_details(letter_key)
             
             # Combine metadata from the list with detailed information
-            letter_data = {**letter_data, "content": content_data}
+            letter_data = {**row.raw, "content": content_data}
             
             # 2. Store letter metadata
             self.document_store.report_metadata(letter_data, json_metadata)
-            print(f"Saved metadata for letter {letter_key}")
+            logging.debug("Saved metadata for letter %s", letter_key)
             
             # 3. Process letter parts
             parts_stored = self._process_letter_parts(letter, content_data)
             if parts_stored > 0:
-                letters_stored += 1
+                if parts_stored == len(content_data.get('parts', [])):
+                    self.document_store.mark_stored('letter', letter_key)
+                return 1
             
         except Exception as e:
-            logging.error(f"Error processing letter {letter_key}: {str(e)}")
+            logging.error("Error processing letter %s: %s", letter_key, e)
         
-        return letters_stored
+        return 0
     
     def _process_letter_parts(self, letter, content_data):
         """
@@ -156,7 +241,7 @@ class LetterFetcher:
         """
         parts = content_data.get('parts', [])
         if not parts:
-            logging.error(f"Letter {letter.key} has no parts")
+            logging.error("Letter %s has no parts", letter.key)
             return 0
         
         parts_stored = 0
@@ -179,7 +264,7 @@ class LetterFetcher:
                 
                 if self.document_store.store(text_content, text_metadata):
                     parts_stored += 1
-                    print(f"Saved text/plain for letter {letter.key}")
+                    logging.debug("Saved text/plain for letter %s", letter.key)
                 
             elif content_type == 'text/html':
                 # Save HTML content
@@ -188,29 +273,38 @@ class LetterFetcher:
                 
                 if self.document_store.store(html_content, html_metadata):
                     parts_stored += 1
-                    print(f"Saved HTML for letter {letter.key}")
+                    logging.debug("Saved HTML for letter %s", letter.key)
                 
             elif content_type == 'application/pdf':
                 # Fetch and save PDF
                 file_key = part.get('key')
                 if not file_key:
-                    logging.warning(f"PDF part in letter {letter.key} missing key")
+                    logging.warning("PDF part in letter %s missing key", letter.key)
+                    continue
+                
+                # The PDF may already be stored by an earlier run that didn't finish
+                # the letter, if the store can tell the parts apart
+                pdf_metadata = part_letter.get_metadata(content_type='application/pdf')
+                if self.document_store.can_check_parts and self.document_store.exists(pdf_metadata):
+                    logging.debug("PDF for letter %s already stored, not fetching it again", letter.key)
+                    parts_stored += 1
                     continue
                 
                 try:
-                    # Fetch PDF content
-                    pdf_content = self.api_client.get_content_file(letter.key, file_key)
-                    
-                    # Store PDF
-                    pdf_metadata = part_letter.get_metadata(content_type='application/pdf')
-                    if self.document_store.store(pdf_content, pdf_metadata):
-                        parts_stored += 1
-                        print(f"Saved PDF for letter {letter.key}")
+                    # Stream the PDF to a temporary file instead of holding it in memory
+                    with tempfile.TemporaryFile() as pdf_file:
+                        self.api_client.get_content_file_stream(letter.key, file_key, pdf_file)
+                        pdf_file.seek(0)
+                        
+                        # Store PDF
+                        if self.document_store.store(pdf_file, pdf_metadata):
+                            parts_stored += 1
+                            logging.debug("Saved PDF for letter %s", letter.key)
                     
                 except Exception as e:
-                    logging.error(f"Error fetching PDF for letter {letter.key}, file {file_key}: {str(e)}")
+                    logging.error("Error fetching PDF for letter %s, file %s: %s", letter.key, file_key, e)
                     raise
             else:
-                logging.warning(f"Unknown content type in letter {letter.key}: {content_type}")
+                logging.warning("Unknown content type in letter %s: %s", letter.key, content_type)
         
         return parts_stored
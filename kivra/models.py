@@ -5,6 +5,8 @@
 This module contains GraphQL queries and data models for Kivra API.
 """
 
+import hashlib
+
 # GraphQL query for fetching receipts
 RECEIPTS_QUERY = """
 query Receipts($search: String, $limit: Int, $offset: Int) {
@@ -121,34 +123,7 @@ query ReceiptDetails($key: String!) {
           items {
             type
             ... on ProductReturnListItem {
-              name
-              money {
-                formatted
-              }
-              quantityCost {
-                formatted
-              }
-              deposits {
-                description
-                money {
-                  formatted
-                }
-                isRefund
-              }
-              costModifiers {
-                description
-                money {
-                  formatted
-                }
-                isRefund
-              }
-              connectedReceipt {
-                receiptKey
-                description
-                isParentReceipt
-              }
-              identifiers
-              text
+              ...productReturnFields
             }
           }
         }
@@ -260,6 +235,37 @@ fragment productFields on ProductListItem {
   identifiers
   text
 }
+
+fragment productReturnFields on ProductReturnListItem {
+  name
+  money {
+    formatted
+  }
+  quantityCost {
+    formatted
+  }
+  deposits {
+    description
+    money {
+      formatted
+    }
+    isRefund
+  }
+  costModifiers {
+    description
+    money {
+      formatted
+    }
+    isRefund
+  }
+  connectedReceipt {
+    receiptKey
+    description
+    isParentReceipt
+  }
+  identifiers
+  text
+}
 """
 
 # GraphQL query for fetching letters
@@ -303,9 +309,17 @@ fragment ContentBaseDetails on IContentBaseDetails {
 }
 """
 
+# SHA-256 of the queries for automatic persisted queries
+RECEIPTS_QUERY_HASH = hashlib.sha256(RECEIPTS_QUERY.encode('utf-8')).hexdigest()
+RECEIPT_DETAILS_QUERY_HASH = hashlib.sha256(RECEIPT_DETAILS_QUERY.encode('utf-8')).hexdigest()
+LETTERS_QUERY_HASH = hashlib.sha256(LETTERS_QUERY.encode('utf-8')).hexdigest()
+
 class KivraDocument:
     """Base class for Kivra documents (receipts and letters)."""
     
+    # One instance is created per document, slots keep them small
+    __slots__ = ('key', 'date', 'content_type')
+    
     def __init__(self, key, date, content_type=None):
         """
         Initialize a Kivra document.
@@ -331,6 +345,8 @@ class KivraDocument:
 class KivraReceipt(KivraDocument):
     """Class representing a Kivra receipt."""
     
+    __slots__ = ('store_name', 'data')
+    
     def __init__(self, key, date, store_name, data=None):
         """
         Initialize a Kivra receipt.
@@ -366,6 +382,8 @@ class KivraReceipt(KivraDocument):
 class KivraLetter(KivraDocument):
     """Class representing a Kivra letter."""
     
+    __slots__ = ('sender_name', 'data', 'part_index')
+    
     def __init__(self, key, date, sender_name, data=None, part_index=None):
         """
         Initialize a Kivra letter.
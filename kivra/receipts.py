@@ -2,22 +2,44 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from utils.helpers import format_date
-from kivra.models import RECEIPTS_QUERY, RECEIPT_DETAILS_QUERY, KivraReceipt
+from utils.progress import ProgressReporter
+from kivra.models import RECEIPTS_QUERY, RECEIPTS_QUERY_HASH, RECEIPT_DETAILS_QUERY, RECEIPT_DETAILS_QUERY_HASH, KivraReceipt
+
+# Number of receipt detail queries sent together in one batched request
+RECEIPT_DETAILS_BATCH_SIZE = 25
+
+@dataclass(slots=True)
+class _ReceiptRow:
+    """The fields of a receipt list entry used while processing it."""
+    key: str
+    date: str
+    store_name: str
 
 class ReceiptFetcher:
     """Class for fetching receipts from Kivra."""
     
-    def __init__(self, api_client, document_store):
+    def __init__(self, api_client, document_store, max_workers=10):
         """
         Initialize the receipt fetcher.
         
         Args:
             api_client (KivraApiClient): Kivra API client
             document_store (DocumentStoreProvider): Document store provider
+            max_workers (int, optional): Number of receipts to process concurrently. Defaults to 10.
         """
         self.api_client = api_client
         self.document_store = document_store
+        self.max_workers = max_workers
+        
+        # Cleared if the server doesn't accept batched queries
+        self._batch_details = True
+        
+        # (receipt key, exception) for each receipt that failed in the last fetch
+        self.failures = []
     
     def fetch_receipts(self, max_count=None):
         """
@@ -30,6 +52,7 @@ class ReceiptFetcher:
             dict: Statistics about fetched receipts
         """
         print("\nFetching receipts...")
+        self.failures = []
         
         # Fetch receipt list
         variables = {
@@ -39,7 +62,7 @@ class ReceiptFetcher:
         }
         
         try:
-            data = self.api_client.graphql_query("Receipts", RECEIPTS_QUERY, variables)
+            data = self.api_client.graphql_query("Receipts", RECEIPTS_QUERY, variables, query_hash=RECEIPTS_QUERY_HASH)
             
             receipts = data.get('data', {}).get('receiptsV2', {})
             receipt_list = receipts.get('list', [])
@@ -55,14 +78,51 @@ class ReceiptFetcher:
                 print(f"\nLimiting to {max_count} receipts (of {len(receipt_list)} available)")
                 receipt_list = receipt_list[:max_count]
             
-            # Add a counter for stored receipts
-            receipts_stored = 0
+            # Pick out the fields needed for processing, and format the dates, in one pass
+            receipt_rows = [
+                _ReceiptRow(
+                    receipt_data.get('key'),
+                    format_date(receipt_data.get('purchaseDate', 'unknown_date')),
+                    (receipt_data.get('store') or {}).get('name', 'unknown_store')
+                )
+                for receipt_data in receipt_list
+            ]
+            
+            # Skip receipts that have already been fetched, checking them all at once
+            # if the document store supports it
+            existing_keys = self.document_store.exists_bulk('receipt', [row.key for row in receipt_rows])
+            pending = [
+                receipt
+                for receipt in (self._prepare_receipt(row, existing_keys) for row in receipt_rows)
+                if receipt is not None
+            ]
+            skipped = len(receipt_rows) - len(pending)
+            if skipped:
+                print(f"\nSkipping {skipped} receipts that have already been fetched")
             
-            # Process each receipt
+            # Process the receipts concurrently, fetching their details in batches.
+            # The next batch of details is fetched while the workers download PDFs.
             print("\nFetching detailed information and PDF for each receipt...")
-            for receipt_data in receipt_list:
-                # Pass the counter to _process_receipt and get the updated value
-                receipts_stored = self._process_receipt(receipt_data, receipts_stored)
+            progress = ProgressReporter(len(pending), "Receipts")
+            
+            def process(receipt, receipt_details):
+                stored = self._process_receipt(receipt, receipt_details)
+                progress.update(stored)
+                return stored
+            
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = []
+                for start in range(0, len(pending), RECEIPT_DETAILS_BATCH_SIZE):
+                    batch = pending[start:start + RECEIPT_DETAILS_BATCH_SIZE]
+                    details = self._fetch_receipt_details([receipt.key for receipt in batch])
+                    for receipt in batch:
+                        futures.append(executor.submit(process, receipt, details.get(receipt.key)))
+                receipts_stored = sum(future.result() for future in futures)
+            progress.close()
+            
+            if self.failures:
+                failed_keys = ', '.join(key for key, _ in self.failures[:5])
+                logging.warning("%s receipts failed, first ones: %s. Last error: %s", len(self.failures), failed_keys, self.failures[-1][1])
                 
             print("\nFinished processing all receipts!")
             
@@ -74,58 +134,124 @@ class ReceiptFetcher:
             }
             
         except Exception as e:
-            logging.error(f"Error fetching receipts: {str(e)}")
+            logging.error("Error fetching receipts: %s", e)
             raise
     
-    def _process_receipt(self, receipt_data, receipts_stored):
+    def _prepare_receipt(self, row, existing_keys=None):
         """
-        Process a single receipt.
+        Create the receipt object for an entry in the receipt list.
         
         Args:
-            receipt_data (dict): Receipt data from the list
-            receipts_stored (int): Counter for stored receipts
+            row (_ReceiptRow): Receipt from the list
+            existing_keys (set, optional): Keys of receipts already in the document store,
+                                           the store is asked per receipt if not given
             
         Returns:
-            int: Updated counter for stored receipts
+            KivraReceipt: The receipt, or None if it should be skipped
         """
-        receipt_key = receipt_data.get('key')
+        receipt_key = row.key
         if not receipt_key:
             logging.warning("Receipt missing key, skipping")
-            return
+            return None
         
-        # Create metadata based on date and store name
-        date = format_date(receipt_data.get('purchaseDate', 'unknown_date'))
-        store = receipt_data.get('store', {}).get('name', 'unknown_store')
+        # Known stored receipts are skipped before building anything for them
+        if existing_keys is not None and receipt_key in existing_keys:
+            logging.debug("Skipping receipt %s - already fetched", receipt_key)
+            return None
         
-        # Create receipt object
-        receipt = KivraReceipt(receipt_key, date, store)
+        # Create receipt object, named by date and store name
+        receipt = KivraReceipt(receipt_key, row.date, row.store_name)
         
         # Check if JSON metadata already exists
-        json_metadata = receipt.get_metadata()
-        if self.document_store.exists(json_metadata):
-            print(f"Skipping receipt {receipt_key} - already fetched")
-            return receipts_stored
+        if existing_keys is None and self.document_store.exists(receipt.get_metadata()):
+            logging.debug("Skipping receipt %s - already fetched", receipt_key)
+            return None
         
-        print(f"\nProcessing receipt: {receipt_key}")
+        return receipt
+    
+    def _fetch_receipt_details(self, receipt_keys):
+        """
+        Fetch the details for several receipts with one batched GraphQL request.
         
+        Args:
+            receipt_keys (list): Keys of the receipts
+            
+        Returns:
+            dict: Receipt details by key. Receipts whose query failed are left out,
+                as are all of them if the batch failed or the server doesn't
+                support batching.
+        """
+        if not self._batch_details or len(receipt_keys) < 2:
+            return {}
+        
+        variables_list = [{"key": key} for key in receipt_keys]
         try:
-            # 1. Fetch detailed receipt information
-            variables = {"key": receipt_key}
-            detail_data = self.api_client.graphql_query("ReceiptDetails", RECEIPT_DETAILS_QUERY, variables)
-            receipt_details = detail_data.get('data', {}).get('receiptV2', {})
+            results = self.api_client.graphql_query_batch(
+                "ReceiptDetails",
+                RECEIPT_DETAILS_QUERY,
+                variables_list,
+                query_hash=RECEIPT_DETAILS_QUERY_HASH
+            )
+        except Exception as e:
+            logging.debug("Batched receipt query failed (%s), fetching these receipt details one by one", e)
+            return {}
+        
+        if results is None:
+            logging.info("GraphQL server doesn't support batched queries, fetching receipt details one by one")
+            self._batch_details = False
+            return {}
+        
+        details = {}
+        for key, result in zip(receipt_keys, results):
+            if not isinstance(result, dict) or 'errors' in result:
+                continue
+            receipt_details = (result.get('data') or {}).get('receiptV2')
+            if receipt_details is not None:
+                details[key] = receipt_details
+        
+        return details
+    
+    def _process_receipt(self, receipt, receipt_details=None):
+        """
+        Process a single receipt.
+        
+        Args:
+            receipt (KivraReceipt): Receipt object
+            receipt_details (dict, optional): Receipt details if already fetched,
+                                              they are queried if not given
+            
+        Returns:
+            int: 1 if the receipt was stored, 0 otherwise
+        """
+        logging.debug("Processing receipt: %s", receipt.key)
+        
+        try:
+            # 1. Fetch detailed receipt information unless it came with a batch
+            if receipt_details is None:
+                variables = {"key": receipt.key}
+                detail_data = self.api_client.graphql_query(
+                    "ReceiptDetails",
+                    RECEIPT_DETAILS_QUERY,
+                    variables,
+                    query_hash=RECEIPT_DETAILS_QUERY_HASH
+                )
+                receipt_details = detail_data.get('data', {}).get('receiptV2', {})
             
             # 2. Store metadata
-            self.document_store.report_metadata(receipt_details, json_metadata)
-            print(f"Saved metadata for receipt {receipt_key}")
+            self.document_store.report_metadata(receipt_details, receipt.get_metadata())
+            logging.debug("Saved metadata for receipt %s", receipt.key)
             
             # 3. Fetch and store PDF
             if self._fetch_and_store_pdf(receipt):
-                receipts_stored += 1
+                self.document_store.mark_stored('receipt', receipt.key)
+                return 1
             
         except Exception as e:
-            logging.error(f"Error processing receipt {receipt_key}: {str(e)}")
+            # Reported together once all receipts have been processed
+            logging.debug("Error processing receipt %s: %s", receipt.key, e)
+            self.failures.append((receipt.key, e))
         
-        return receipts_stored
+        return 0
     
     def _fetch_and_store_pdf(self, receipt):
         """
@@ -137,19 +263,16 @@ class ReceiptFetcher:
         Returns:
             bool: True if PDF was stored, False otherwise
         """
-        try:
-            # Construct PDF URL
-            pdf_url = f"https://app.api.kivra.com/v1/user/{self.api_client.actor_key}/receipts/{receipt.key}"
-            
-            # Fetch PDF
-            pdf_content = self.api_client.get_pdf(pdf_url)
+        # Construct PDF URL
+        pdf_url = f"https://app.api.kivra.com/v1/user/{self.api_client.actor_key}/receipts/{receipt.key}"
+        
+        # Stream the PDF to a temporary file instead of holding it in memory
+        with tempfile.TemporaryFile() as pdf_file:
+            self.api_client.get_pdf_stream(pdf_url, pdf_file)
+            pdf_file.seek(0)
             
             # Store PDF
             pdf_metadata = receipt.get_metadata(content_type='application/pdf')
-            result = self.document_store.store(pdf_content, pdf_metadata)
-            print(f"Saved PDF for receipt {receipt.key}")
-            return result
-            
-        except Exception as e:
-            logging.error(f"Error fetching PDF for receipt {receipt.key}: {str(e)}")
-            raise
+            result = self.document_store.store(pdf_file, pdf_metadata)
+        logging.debug("Saved PDF for receipt %s", receipt.key)
+        return result
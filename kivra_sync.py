@@ -14,6 +14,7 @@ from kivra.api import KivraApiClient
 from kivra.receipts import ReceiptFetcher
 from kivra.letters import LetterFetcher
 from storage.filesystem import FileSystemStoreProvider
+from utils.pdf import warm_up as warm_up_pdf
 from interaction.local import LocalInteractionProvider
 from interaction.ntfy import NtfyInteractionProvider
 from interaction.web import WebInteractionProvider
@@ -32,16 +33,22 @@ def fetch_documents(args, interaction_provider, document_store, temp_dir):
         int: Exit code (0 for success, non-zero for failure)
     """
     try:
-        # Authenticate with Kivra
-        auth = KivraAuth(temp_dir, interaction_provider)
+        # Letters may need HTML converted to PDF, get the renderer loaded while
+        # the user authenticates
+        if args.fetch_letters:
+            warm_up_pdf()
+        
+        # Authenticate with Kivra. The session keeps one connection per worker
+        # plus one for the receipt detail batches.
+        auth = KivraAuth(temp_dir, interaction_provider, pool_size=args.concurrency + 1)
         token_info = auth.authenticate(args.ssn)
         
         # Extract tokens
         access_token = token_info['access_token']
         actor_key = token_info['actor_key']
         
-        # Initialize API client
-        api_client = KivraApiClient(access_token, actor_key)
+        # Initialize API client, reusing the connections opened during authentication
+        api_client = KivraApiClient(access_token, actor_key, session=auth.session, cache_dir=temp_dir)
         
         # Initialize statistics
         stats = {
@@ -55,13 +62,13 @@ def fetch_documents(args, interaction_provider, document_store, temp_dir):
         
         # Fetch receipts if enabled
         if args.fetch_receipts:
-            receipt_fetcher = ReceiptFetcher(api_client, document_store)
+            receipt_fetcher = ReceiptFetcher(api_client, document_store, max_workers=args.concurrency)
             receipt_stats = receipt_fetcher.fetch_receipts(max_count=None if args.max_receipts == 0 else args.max_receipts)
             stats.update(receipt_stats)
         
         # Fetch letters if enabled
         if args.fetch_letters:
-            letter_fetcher = LetterFetcher(api_client, document_store)
+            letter_fetcher = LetterFetcher(api_client, document_store, max_workers=args.concurrency)
             letter_stats = letter_fetcher.fetch_letters(max_count=None if args.max_letters == 0 else args.max_letters)
             stats.update(letter_stats)
         
@@ -96,6 +103,10 @@ def main():
     parser.add_argument('--interaction-provider', choices=['local', 'ntfy', 'web'], default='local',
                         help='Interaction provider to use (default: local)')
     
+    # Local provider options
+    parser.add_argument('--ascii-qr', action='store_true',
+                        help='Print the QR code in the terminal instead of opening an image viewer (local provider only)')
+    
     # ntfy provider options
     parser.add_argument('--ntfy-topic', help='ntfy topic to send notifications to')
     parser.add_argument('--ntfy-server', default='https://ntfy.sh', help='ntfy server URL (default: https://ntfy.sh)')
@@ -123,9 +134,13 @@ def main():
     parser.add_argument('--no-fetch-letters', action='store_false', dest='fetch_letters', help='Do not fetch letters')
     parser.add_argument('--max-receipts', type=int, default=0, help='Maximum number of receipts to fetch (default: 0, 0 for unlimited)')
     parser.add_argument('--max-letters', type=int, default=0, help='Maximum number of letters to fetch (default: 0, 0 for unlimited)')
+    parser.add_argument('--concurrency', type=int, default=10, help='Number of documents to fetch concurrently (default: 10)')
     
     args = parser.parse_args()
     
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    
     # Create temp directory for QR codes and other temporary files
     # Prefer env overrides and OS temp; avoid writing into read-only installs
     script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -161,7 +176,7 @@ def main():
     
     # Initialize the interaction provider
     if args.interaction_provider == 'local':
-        interaction_provider = LocalInteractionProvider()
+        interaction_provider = LocalInteractionProvider(ascii_qr=args.ascii_qr)
     elif args.interaction_provider == 'ntfy':
         if not args.ntfy_topic:
             parser.error("--ntfy-topic is required when using the ntfy interaction provider")
@@ -31,13 +31,74 @@ class DocumentStoreProvider(ABC):
         """
         pass
     
+    @property
+    def can_check_parts(self):
+        """
+        Indicates if exists() answers for the individual file of a letter part,
+        rather than for the document as a whole.
+        
+        Returns:
+            bool: True if parts are checked separately, False otherwise
+        """
+        return False
+    
+    def list_existing_keys(self, doc_type):
+        """
+        List the keys of all documents of a type that already exist in the store.
+        
+        Lets callers replace one exists() call per document with a single listing.
+        Providers that can't list their documents cheaply don't need to implement it.
+        
+        Args:
+            doc_type (str): Type of document (receipt/letter)
+        
+        Returns:
+            set: Keys of the existing documents, or None if listing isn't supported
+        """
+        return None
+    
+    def exists_bulk(self, doc_type, keys):
+        """
+        Check which of several documents already exist in the store.
+        
+        Uses list_existing_keys() by default, so providers only need to override
+        this if they can check a known set of keys more cheaply than listing all.
+        
+        Args:
+            doc_type (str): Type of document (receipt/letter)
+            keys (iterable): Keys of the documents to check
+        
+        Returns:
+            set: The given keys that already exist, or None if bulk checks aren't
+                 supported and exists() has to be used per document
+        """
+        existing_keys = self.list_existing_keys(doc_type)
+        if existing_keys is None:
+            return None
+        
+        return existing_keys.intersection(keys)
+    
+    def mark_stored(self, doc_type, key):
+        """
+        Record that all files of a document have been stored.
+        
+        Called once per document after store() succeeded for each of its files,
+        so providers that keep a listing of stored keys can add the document.
+        
+        Args:
+            doc_type (str): Type of document (receipt/letter)
+            key (str): Document key
+        """
+        pass
+    
     @abstractmethod
     def store(self, data, metadata):
         """
         Store document data and metadata.
         
         Args:
-            data (bytes or dict): The document content (PDF bytes, text, HTML, or JSON)
+            data (bytes, file or dict): The document content (PDF bytes or a binary
+                            file object positioned at the start, text, HTML, or JSON)
             metadata (dict): Document metadata including type (receipt/letter),
                             date, sender/store name, document key, content_type, etc.
         
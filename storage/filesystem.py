@@ -1,13 +1,89 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import io
 import os
-import json
+import stat
+import shutil
 import logging
 from storage.base import DocumentStoreProvider
-from utils.helpers import clean_filename
+from utils.helpers import clean_filename, json_dumps_indent
 from utils.pdf import html_to_pdf
 
+# File name suffix of the stored file for each content type
+STORED_FILE_SUFFIXES = {
+    'application/json': '.json',
+    'application/pdf': '.pdf',
+    'text/plain': '.txt',
+    'text/html': '_html.pdf'
+}
+
+def _write_bytes(path, data):
+    """
+    Write bytes to a file, handing the whole buffer to the kernel instead of going
+    through a buffered file object.
+    
+    Args:
+        path (str): File path
+        data (bytes): Content to write
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+    finally:
+        os.close(fd)
+
+def _write_file_object(path, src):
+    """
+    Copy a binary file object to a file, from its current position to the end.
+    
+    Regular files are copied in the kernel with os.sendfile() where available,
+    anything else in 1 MiB chunks.
+    
+    Args:
+        path (str): File path
+        src (file): Binary file object to copy
+    """
+    with open(path, 'wb') as f:
+        if hasattr(os, 'sendfile'):
+            try:
+                src_fd = src.fileno()
+                src_stat = os.fstat(src_fd)
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                src_stat = None
+            
+            if src_stat is not None and stat.S_ISREG(src_stat.st_mode):
+                offset = src.tell()
+                while offset < src_stat.st_size:
+                    sent = os.sendfile(f.fileno(), src_fd, offset, src_stat.st_size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+                src.seek(offset)
+                return
+        
+        shutil.copyfileobj(src, f, length=1 << 20)
+
+def _path_exists(path):
+    """
+    Check if a path exists without following symlinks, which saves resolving
+    them when all that matters is whether the name is taken.
+    
+    Args:
+        path (str): Path to check
+        
+    Returns:
+        bool: True if the path exists
+    """
+    try:
+        os.stat(path, follow_symlinks=False)
+    except (OSError, ValueError):
+        return False
+    return True
+
 class FileSystemStoreProvider(DocumentStoreProvider):
     """Storage provider that stores documents in the file system."""
     
@@ -21,8 +97,33 @@ class FileSystemStoreProvider(DocumentStoreProvider):
         """
         self.base_dir = base_dir
         self.dry_run = dry_run
+        
+        # Directories known to exist, so they're only created once per run
+        self._known_dirs = set()
+        
+        # Snapshot of the file names in each directory exists() has looked in
+        self._dir_listings = {}
+        
+        # Paths by (type, store/sender name, date, key), see _get_filepath()
+        self._filepaths = {}
         self._ensure_directories()
     
+    @property
+    def can_check_parts(self):
+        """
+        Indicates if exists() answers for the individual file of a letter part.
+        
+        Returns:
+            bool: Always True, every part is stored in its own file
+        """
+        return True
+    
+    def _reset_caches(self):
+        """Forget the directories, directory snapshots and paths remembered so far."""
+        self._known_dirs.clear()
+        self._dir_listings.clear()
+        self._filepaths.clear()
+    
     def _ensure_directories(self):
         """Create necessary directory structure."""
         os.makedirs(self.base_dir, exist_ok=True)
@@ -30,14 +131,28 @@ class FileSystemStoreProvider(DocumentStoreProvider):
         # Create directories for receipts
         self.receipts_dir = os.path.join(self.base_dir, "Receipts")
         self.receipts_json_dir = os.path.join(self.receipts_dir, "json")
-        os.makedirs(self.receipts_dir, exist_ok=True)
-        os.makedirs(self.receipts_json_dir, exist_ok=True)
+        self._ensure_dir(self.receipts_dir)
+        self._ensure_dir(self.receipts_json_dir)
         
         # Create directories for letters
         self.letters_dir = os.path.join(self.base_dir, "Letters")
         self.letters_json_dir = os.path.join(self.letters_dir, "json")
-        os.makedirs(self.letters_dir, exist_ok=True)
-        os.makedirs(self.letters_json_dir, exist_ok=True)
+        self._ensure_dir(self.letters_dir)
+        self._ensure_dir(self.letters_json_dir)
+    
+    def _ensure_dir(self, path):
+        """
+        Create a directory unless it's already known to exist.
+        
+        Args:
+            path (str): Directory path
+        """
+        if path not in self._known_dirs:
+            # A stat is cheaper than a mkdir failing with EEXIST, and on later
+            # runs most directories already exist
+            if not os.path.isdir(path):
+                os.makedirs(path, exist_ok=True)
+            self._known_dirs.add(path)
     
     def _get_filepath(self, metadata):
         """
@@ -53,38 +168,53 @@ class FileSystemStoreProvider(DocumentStoreProvider):
         date = metadata.get('date', 'unknown_date')
         
         if doc_type == 'receipt':
-            store_name = metadata.get('store_name', 'unknown_store')
-            safe_store = clean_filename(store_name)
-            
-            # Create store-specific directories if they don't exist
-            store_dir = os.path.join(self.receipts_dir, safe_store)
-            store_json_dir = os.path.join(self.receipts_json_dir, safe_store)
-            os.makedirs(store_dir, exist_ok=True)
-            os.makedirs(store_json_dir, exist_ok=True)
-            
-            filename_base = f"{date}_{safe_store}_{metadata.get('key')}"
-            return store_dir, store_json_dir, filename_base
-            
+            name = metadata.get('store_name', 'unknown_store')
         elif doc_type == 'letter':
-            sender_name = metadata.get('sender_name', 'unknown_sender')
-            safe_sender = clean_filename(sender_name)
-            
-            # Create sender-specific directories if they don't exist
-            sender_dir = os.path.join(self.letters_dir, safe_sender)
-            sender_json_dir = os.path.join(self.letters_json_dir, safe_sender)
-            os.makedirs(sender_dir, exist_ok=True)
-            os.makedirs(sender_json_dir, exist_ok=True)
-            
-            filename_base = f"{date}_{safe_sender}_{metadata.get('key')}"
+            name = metadata.get('sender_name', 'unknown_sender')
+        else:
+            raise ValueError(f"Unknown document type: {doc_type}")
+        
+        # The paths are the same for every file of a document, only the part differs
+        cache_key = (doc_type, name, date, metadata.get('key'))
+        paths = self._filepaths.get(cache_key)
+        if paths is None:
+            paths = self._filepaths[cache_key] = self._build_filepath(*cache_key)
+        
+        # Add part index if specified
+        part_index = metadata.get('part_index')
+        if doc_type == 'letter' and part_index is not None:
+            dir_path, json_dir, filename_base = paths
+            return dir_path, json_dir, f"{filename_base}_part{part_index}"
+        
+        return paths
+    
+    def _build_filepath(self, doc_type, name, date, key):
+        """
+        Generate the directories and base filename for a document, creating the
+        directories if they don't exist.
+        
+        Args:
+            doc_type (str): Type of document (receipt/letter)
+            name (str): Store name for receipts, sender name for letters
+            date (str): Document date
+            key (str): Document key
             
-            # Add part index if specified
-            if metadata.get('part_index') is not None:
-                filename_base = f"{filename_base}_part{metadata.get('part_index')}"
-                
-            return sender_dir, sender_json_dir, filename_base
+        Returns:
+            tuple: (directory_path, json_dir_path, filename_base)
+        """
+        safe_name = clean_filename(name)
         
+        # Create store or sender specific directories if they don't exist
+        if doc_type == 'receipt':
+            dir_path = os.path.join(self.receipts_dir, safe_name)
+            json_dir = os.path.join(self.receipts_json_dir, safe_name)
         else:
-            raise ValueError(f"Unknown document type: {doc_type}")
+            dir_path = os.path.join(self.letters_dir, safe_name)
+            json_dir = os.path.join(self.letters_json_dir, safe_name)
+        self._ensure_dir(dir_path)
+        self._ensure_dir(json_dir)
+        
+        return dir_path, json_dir, f"{date}_{safe_name}_{key}"
     
     def report_listing(self, doc_type, listing):
         """
@@ -101,11 +231,48 @@ class FileSystemStoreProvider(DocumentStoreProvider):
             elif doc_type == 'letters':
                 store_json_dir = os.path.join(self.letters_json_dir, 'letters.json')
 
-            with open(store_json_dir, 'w', encoding='utf-8') as f:
-                json.dump(listing, f, ensure_ascii=False, indent=2)
+            # Serialize first so the file is written in one go rather than per token
+            with open(store_json_dir, 'wb') as f:
+                f.write(json_dumps_indent(listing))
         except Exception as e:
             logging.error(f"Error storing document listing: {str(e)}")
 
+    def _file_exists(self, path):
+        """
+        Check if a file exists using a snapshot of its directory.
+        
+        The directory is listed with one scandir the first time a file in it is
+        checked, later checks in the same directory are set lookups.
+        
+        Args:
+            path (str): File path
+            
+        Returns:
+            bool: True if the file exists
+        """
+        dir_path, filename = os.path.split(path)
+        listing = self._dir_listings.get(dir_path)
+        if listing is None:
+            try:
+                with os.scandir(dir_path) as entries:
+                    listing = {entry.name for entry in entries}
+            except OSError:
+                return _path_exists(path)
+            self._dir_listings[dir_path] = listing
+        return filename in listing
+    
+    def _add_to_listing(self, path):
+        """
+        Add a newly written file to its directory snapshot, if there is one.
+        
+        Args:
+            path (str): File path
+        """
+        dir_path, filename = os.path.split(path)
+        listing = self._dir_listings.get(dir_path)
+        if listing is not None:
+            listing.add(filename)
+    
     def exists(self, metadata):
         """
         Check if document already exists based on metadata.
@@ -116,30 +283,72 @@ class FileSystemStoreProvider(DocumentStoreProvider):
         Returns:
             bool: True if exists, False otherwise
         """
+        # Unsupported content types are never stored, skip building their path
+        content_type = metadata.get('content_type', '')
+        suffix = STORED_FILE_SUFFIXES.get(content_type)
+        if suffix is None:
+            return False
+        
         try:
             file_dir, json_dir, filename_base = self._get_filepath(metadata)
-            
-            # For JSON metadata check
-            if metadata.get('content_type') == 'application/json':
-                json_path = os.path.join(json_dir, f"{filename_base}.json")
-                return os.path.exists(json_path)
-            
-            # For content files check
-            content_type = metadata.get('content_type', '')
-            if content_type == 'application/pdf':
-                file_path = os.path.join(file_dir, f"{filename_base}.pdf")
-                return os.path.exists(file_path)
-            elif content_type == 'text/plain':
-                file_path = os.path.join(file_dir, f"{filename_base}.txt")
-                return os.path.exists(file_path)
-            elif content_type == 'text/html':
-                file_path = os.path.join(file_dir, f"{filename_base}_html.pdf")
-                return os.path.exists(file_path)
-            
+        except OSError as e:
+            logging.error(f"Error creating document directory: {str(e)}")
             return False
+        
+        # JSON metadata is kept apart from the content files
+        if content_type == 'application/json':
+            file_dir = json_dir
+        
+        return self._file_exists(os.path.join(file_dir, f"{filename_base}{suffix}"))
+    
+    def list_existing_keys(self, doc_type):
+        """
+        List the keys of all documents of a type that have their JSON metadata stored.
+        
+        Args:
+            doc_type (str): Type of document (receipt/letter)
+            
+        Returns:
+            set: Keys of the existing documents, or None if they couldn't be listed
+        """
+        # Called at the start of every sync, in listen mode the provider outlives
+        # a single one and files may have changed on disk in between
+        self._reset_caches()
+        
+        if doc_type == 'receipt':
+            json_dir = self.receipts_json_dir
+        elif doc_type == 'letter':
+            json_dir = self.letters_json_dir
+        else:
+            return None
+        
+        keys = set()
+        try:
+            with os.scandir(json_dir) as entries:
+                for entry in entries:
+                    if not entry.is_dir():
+                        continue
+                    
+                    # Files are named {date}_{name}_{key}.json in a directory called {name}
+                    name_prefix = f"{entry.name}_"
+                    with os.scandir(entry.path) as files:
+                        for file_entry in files:
+                            filename = file_entry.name
+                            if not filename.endswith('.json'):
+                                continue
+                            
+                            if filename.startswith('unknown_date_'):
+                                rest = filename[len('unknown_date_'):]
+                            else:
+                                rest = filename.partition('_')[2]
+                            
+                            if rest.startswith(name_prefix):
+                                keys.add(rest[len(name_prefix):-len('.json')])
         except Exception as e:
-            logging.error(f"Error checking if document exists: {str(e)}")
-            return False
+            logging.error(f"Error listing existing documents: {str(e)}")
+            return None
+        
+        return keys
     
     def report_metadata(self, data, metadata):
         """
@@ -154,77 +363,100 @@ class FileSystemStoreProvider(DocumentStoreProvider):
         """
         try:
             dir_path, json_dir, filename_base = self._get_filepath(metadata)
-            
-            # Store as JSON file
-            json_path = os.path.join(json_dir, f"{filename_base}.json")
-            
-            if self.dry_run:
-                logging.info(f"DRY RUN: Would store metadata to {json_path}")
-                return True
-                
-            with open(json_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+        except OSError as e:
+            logging.error(f"Error creating document directory: {str(e)}")
+            return False
+        
+        # Store as JSON file
+        json_path = os.path.join(json_dir, f"{filename_base}.json")
+        
+        if self.dry_run:
+            logging.info(f"DRY RUN: Would store metadata to {json_path}")
             return True
-        except Exception as e:
+        
+        try:
+            with open(json_path, 'wb') as f:
+                f.write(json_dumps_indent(data))
+        except (OSError, TypeError) as e:
             logging.error(f"Error storing document metadata: {str(e)}")
             return False
+        
+        self._add_to_listing(json_path)
+        return True
     
     def store(self, data, metadata):
         """
         Store document data and metadata in the file system.
         
         Args:
-            data (bytes or dict): The document content
+            data (bytes, file or dict): The document content
             metadata (dict): Document metadata
             
         Returns:
             bool: True if successful, False otherwise
         """
+        content_type = metadata.get('content_type', '')
+        if content_type not in ('application/pdf', 'text/plain', 'text/html'):
+            logging.warning(f"Unsupported content type: {content_type}")
+            return False
+        
         try:
             dir_path, json_dir, filename_base = self._get_filepath(metadata)
-            content_type = metadata.get('content_type', '')
-            
-            # Store content files
-            if content_type == 'application/pdf':
-                file_path = os.path.join(dir_path, f"{filename_base}.pdf")
-                if self.dry_run:
-                    logging.info(f"DRY RUN: Would store PDF to {file_path}")
-                    return True
-                with open(file_path, 'wb') as f:
-                    f.write(data)
+        except OSError as e:
+            logging.error(f"Error creating document directory: {str(e)}")
+            return False
+        
+        # Store content files
+        if content_type == 'application/pdf':
+            file_path = os.path.join(dir_path, f"{filename_base}.pdf")
+            if self.dry_run:
+                logging.info(f"DRY RUN: Would store PDF to {file_path}")
                 return True
-            elif content_type == 'text/plain':
-                file_path = os.path.join(dir_path, f"{filename_base}.txt")
-                if self.dry_run:
-                    logging.info(f"DRY RUN: Would store text to {file_path}")
-                    return True
+            try:
+                if hasattr(data, 'read'):
+                    _write_file_object(file_path, data)
+                else:
+                    _write_bytes(file_path, data)
+            except OSError as e:
+                logging.error(f"Error storing document: {str(e)}")
+                return False
+            self._add_to_listing(file_path)
+            return True
+        elif content_type == 'text/plain':
+            file_path = os.path.join(dir_path, f"{filename_base}.txt")
+            if self.dry_run:
+                logging.info(f"DRY RUN: Would store text to {file_path}")
+                return True
+            try:
                 with open(file_path, 'w', encoding='utf-8') as f:
                     f.write(data)
+            except OSError as e:
+                logging.error(f"Error storing document: {str(e)}")
+                return False
+            self._add_to_listing(file_path)
+            return True
+        else:  # text/html
+            file_path = os.path.join(dir_path, f"{filename_base}_html.pdf")
+            if self.dry_run:
+                logging.info(f"DRY RUN: Would store HTML as PDF to {file_path}")
+                return True
+            
+            # Render straight into the file, html_to_pdf() logs and returns None on failure
+            if html_to_pdf(data, target=file_path):
+                self._add_to_listing(file_path)
                 return True
-            elif content_type == 'text/html':
-                # Use the extracted HTML to PDF conversion utility
-                pdf_data = html_to_pdf(data)
+            else:
+                # Don't leave a partly written PDF behind to be taken as stored
+                try:
+                    os.unlink(file_path)
+                except OSError:
+                    pass
                 
-                if pdf_data:
-                    file_path = os.path.join(dir_path, f"{filename_base}_html.pdf")
-                    if self.dry_run:
-                        logging.info(f"DRY RUN: Would store HTML as PDF to {file_path}")
-                        return True
-                    with open(file_path, 'wb') as f:
-                        f.write(pdf_data)
-                    return True
-                else:
-                    # Fallback to saving HTML source if conversion fails
-                    file_path = os.path.join(dir_path, f"{filename_base}_html.html")
-                    if self.dry_run:
-                        logging.info(f"DRY RUN: Would store HTML source to {file_path}")
-                        return True
+                # Fallback to saving HTML source if conversion fails
+                file_path = os.path.join(dir_path, f"{filename_base}_html.html")
+                try:
                     with open(file_path, 'w', encoding='utf-8') as f:
                         f.write(data)
-                    return False
-            
-            logging.warning(f"Unsupported content type: {content_type}")
-            return False
-        except Exception as e:
-            logging.error(f"Error storing document: {str(e)}")
-            return False
+                except OSError as e:
+                    logging.error(f"Error storing document: {str(e)}")
+                return False
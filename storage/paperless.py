@@ -2,11 +2,24 @@
 # -*- coding: utf-8 -*-
 
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
 import re
+import threading
+import concurrent.futures
 from datetime import datetime
 from storage.base import DocumentStoreProvider
+from utils.helpers import json_dumps_indent
+
+# Documents requested per page when listing the stored documents
+DOCUMENTS_PAGE_SIZE = 1000
+
+# Dates as formatted by utils.helpers.format_date()
+DATE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+# Filenames created by store(), {date}_{correspondent}_{key}[_part{n}].{extension}
+FILENAME_PATTERN = re.compile(r'^(?:\d{4}-\d{2}-\d{2}|unknown_date)_(.+?)(?:_part\d+)?(?:\.\w+)?$')
 
 class PaperlessNgxStoreProvider(DocumentStoreProvider):
     """Storage provider that stores documents in paperless-ngx."""
@@ -33,6 +46,31 @@ class PaperlessNgxStoreProvider(DocumentStoreProvider):
             'Accept': 'application/json'
         })
         
+        # Keep a connection per concurrent worker and retry idempotent requests on
+        # transient server errors. Uploads are POSTs and aren't retried. The last
+        # response is returned if retries run out, so status checks work as before.
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 502, 503, 504], raise_on_status=False)
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        
+        # Documents may be stored from several threads, serialize the
+        # lookups that can create correspondents and document types
+        self._lookup_lock = threading.Lock()
+        
+        # IDs by lowercased name, None if looking up or creating it failed
+        self._correspondent_ids = {}
+        self._document_type_ids = {}
+        
+        # Keys of the documents in paperless-ngx, listed on first use and again
+        # at the start of every sync, see _get_existing_keys()
+        self._existing_keys = None
+        self._existing_keys_loaded = False
+        self._existing_keys_lock = threading.Lock()
+        
         # Get tag IDs if tags are provided
         self.tag_ids = self._get_tag_ids(self.tags) if self.tags else []
     
@@ -46,48 +84,86 @@ class PaperlessNgxStoreProvider(DocumentStoreProvider):
         Returns:
             list: List of tag IDs
         """
-        tag_ids = []
-        
-        logging.info(f"Processing tags: {tag_names}")
+        logging.info("Processing tags: %s", tag_names)
         
+        # Tag names match case-insensitively, look each one up only once so
+        # the parallel lookups can't create the same tag twice
+        unique_names = []
+        seen = set()
         for tag_name in tag_names:
-            # Log the tag we're looking for
-            logging.info(f"Looking for tag: {tag_name}")
-            
-            # Check if tag exists - use case-insensitive exact match
-            response = self.session.get(
-                f"{self.api_url}/tags/?name__iexact={tag_name}"
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                if data['count'] > 0:
-                    tag_id = data['results'][0]['id']
-                    tag_ids.append(tag_id)
-                    logging.info(f"Found existing tag '{tag_name}' with ID {tag_id}")
-                    continue
-            
-            # Create new tag if not found
-            response = self.session.post(
-                f"{self.api_url}/tags/",
-                json={'name': tag_name},
-                headers={'Content-Type': 'application/json'}
-            )
-            
-            if response.status_code in [200, 201]:
-                tag_id = response.json()['id']
-                tag_ids.append(tag_id)
-                logging.info(f"Created new tag '{tag_name}' with ID {tag_id}")
-            else:
-                logging.warning(f"Failed to create tag '{tag_name}': {response.status_code}, Response: {response.text}")
+            if tag_name.lower() not in seen:
+                seen.add(tag_name.lower())
+                unique_names.append(tag_name)
+        
+        # Look the tags up in parallel, each one takes up to two round trips
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(unique_names))) as executor:
+            results = list(executor.map(self._get_tag_id, unique_names))
         
-        logging.info(f"Using tag IDs: {tag_ids}")
+        tag_ids = [tag_id for tag_id in results if tag_id is not None]
+        
+        logging.info("Using tag IDs: %s", tag_ids)
         return tag_ids
     
+    def _get_tag_id(self, tag_name):
+        """
+        Get the ID of a tag, creating it if it doesn't exist.
+        
+        Args:
+            tag_name (str): Tag name
+            
+        Returns:
+            int: Tag ID, or None if the tag couldn't be created
+        """
+        # Log the tag we're looking for
+        logging.info("Looking for tag: %s", tag_name)
+        
+        # Check if tag exists - use case-insensitive exact match
+        response = self.session.get(
+            f"{self.api_url}/tags/?name__iexact={tag_name}"
+        )
+        
+        if response.status_code == 200:
+            data = response.json()
+            if data['count'] > 0:
+                tag_id = data['results'][0]['id']
+                logging.info("Found existing tag '%s' with ID %s", tag_name, tag_id)
+                return tag_id
+        
+        # Create new tag if not found
+        response = self.session.post(
+            f"{self.api_url}/tags/",
+            json={'name': tag_name},
+            headers={'Content-Type': 'application/json'}
+        )
+        
+        if response.status_code in [200, 201]:
+            tag_id = response.json()['id']
+            logging.info("Created new tag '%s' with ID %s", tag_name, tag_id)
+            return tag_id
+        
+        logging.warning("Failed to create tag '%s': %s, Response: %s", tag_name, response.status_code, response.text)
+        return None
+    
     def _get_correspondent_id(self, sender_name):
         """
         Get correspondent ID for a sender name, creating one if it doesn't exist.
         
+        Args:
+            sender_name (str): Name of the sender/correspondent
+            
+        Returns:
+            int: Correspondent ID
+        """
+        cache_key = (sender_name or '').lower()
+        if cache_key not in self._correspondent_ids:
+            self._correspondent_ids[cache_key] = self._lookup_correspondent_id(sender_name)
+        return self._correspondent_ids[cache_key]
+    
+    def _lookup_correspondent_id(self, sender_name):
+        """
+        Look up the correspondent ID for a sender name in paperless-ngx, creating
+        the correspondent if it doesn't exist.
+        
         Args:
             sender_name (str): Name of the sender/correspondent
             
@@ -95,10 +171,10 @@ class PaperlessNgxStoreProvider(DocumentStoreProvider):
             int: Correspondent ID
         """
         if not sender_name or sender_name.lower() in ['unknown store', 'unknown sender']:
-            logging.warning(f"Invalid correspondent name: {sender_name}, skipping correspondent")
+            logging.warning("Invalid correspondent name: %s, skipping correspondent", sender_name)
             return None
             
-        logging.info(f"Looking for correspondent: {sender_name}")
+        logging.info("Looking for correspondent: %s", sender_name)
         
         # First check if correspondent exists - use exact match
         try:
@@ -115,7 +191,7 @@ class PaperlessNgxStoreProvider(DocumentStoreProvider):
                 data = response.json()
                 if data['count'] > 0:
                     correspondent_id = data['results'][0]['id']
-                    logging.info(f"Found existing correspondent '{sender_name}' with ID {correspondent_id}")
+                    logging.info("Found existing correspondent '%s' with ID %s", sender_name, correspondent_id)
                     return correspondent_id
                     
             # If no exact match, try contains match
@@ -127,14 +203,14 @@ class PaperlessNgxStoreProvider(DocumentStoreProvider):
                 data = response.json()
                 if data['count'] > 0:
                     correspondent_id = data['results'][0]['id']
-                    logging.info(f"Found similar correspondent '{data['results'][0]['name']}' with ID {correspondent_id}")
+                    logging.info("Found similar correspondent '%s' with ID %s", data['results'][0]['name'], correspondent_id)
                     return correspondent_id
         except Exception as e:
-            logging.error(f"Error searching for correspondent: {str(e)}")
+            logging.error("Error searching for correspondent: %s", e)
         
         # Create new correspondent if not found
         try:
-            logging.info(f"Creating new correspondent: {sender_name}")
+            logging.info("Creating new correspondent: %s", sender_name)
             response = self.session.post(
                 f"{self.api_url}/correspondents/",
                 json={'name': sender_name, 'matching_algorithm': 6},
@@ -143,12 +219,12 @@ class PaperlessNgxStoreProvider(DocumentStoreProvider):
             
             if response.status_code in [200, 201]:
                 correspondent_id = response.json()['id']
-                logging.info(f"Created new correspondent '{sender_name}' with ID {correspondent_id}")
+                logging.info("Created new correspondent '%s' with ID %s", sender_name, correspondent_id)
                 return correspondent_id
             else:
-                logging.warning(f"Failed to create correspondent for '{sender_name}': {response.status_code}, Response: {response.text}")
+                logging.warning("Failed to create correspondent for '%s': %s, Response: %s", sender_name, response.status_code, response.text)
         except Exception as e:
-            logging.error(f"Error creating correspondent: {str(e)}")
+            logging.error("Error creating correspondent: %s", e)
         
         # Return None if creation fails
         logging.warning("Failed to create correspondent, correspondent will be skipped")
@@ -173,28 +249,51 @@ class PaperlessNgxStoreProvider(DocumentStoreProvider):
         
         paperless_type = type_mapping.get(doc_type, 'Document')
         
-        # Check if document type exists - use case-insensitive exact match
-        response = self.session.get(
-            f"{self.api_url}/document_types/?name__iexact={paperless_type}"
-        )
+        cache_key = paperless_type.lower()
+        if cache_key not in self._document_type_ids:
+            self._document_type_ids[cache_key] = self._lookup_document_type_id(doc_type, paperless_type)
+        return self._document_type_ids[cache_key]
+    
+    def _lookup_document_type_id(self, doc_type, paperless_type):
+        """
+        Look up a document type ID in paperless-ngx, creating the document type if
+        it doesn't exist.
         
-        if response.status_code == 200:
-            data = response.json()
-            if data['count'] > 0:
-                return data['results'][0]['id']
+        Args:
+            doc_type (str): Type of document ('receipt' or 'letter')
+            paperless_type (str): Name of the document type in paperless-ngx
+            
+        Returns:
+            int: Document type ID
+        """
+        # Check if document type exists - use case-insensitive exact match
+        try:
+            response = self.session.get(
+                f"{self.api_url}/document_types/?name__iexact={paperless_type}"
+            )
+            
+            if response.status_code == 200:
+                data = response.json()
+                if data['count'] > 0:
+                    return data['results'][0]['id']
+        except Exception as e:
+            logging.error("Error searching for document type: %s", e)
         
         # Create new document type if not found
-        response = self.session.post(
-            f"{self.api_url}/document_types/",
-            json={'name': paperless_type},
-            headers={'Content-Type': 'application/json'}
-        )
-        
-        if response.status_code in [200, 201]:
-            return response.json()['id']
+        try:
+            response = self.session.post(
+                f"{self.api_url}/document_types/",
+                json={'name': paperless_type},
+                headers={'Content-Type': 'application/json'}
+            )
+            
+            if response.status_code in [200, 201]:
+                return response.json()['id']
+        except Exception as e:
+            logging.error("Error creating document type: %s", e)
         
         # Return None if creation fails
-        logging.warning(f"Failed to get/create document type for {doc_type}, document type will be skipped")
+        logging.warning("Failed to get/create document type for %s, document type will be skipped", doc_type)
         return None
     
     def report_listing(self, doc_type, listing):
@@ -234,17 +333,119 @@ class PaperlessNgxStoreProvider(DocumentStoreProvider):
         Returns:
             str: ISO formatted date with timezone
         """
+        # Check if date is in YYYY-MM-DD format
+        if isinstance(date_str, str) and DATE_PATTERN.match(date_str):
+            # Convert to ISO format with time and timezone
+            return f"{date_str}T00:00:00Z"
+        
+        logging.warning("Date format not recognized: %s, using current date", date_str)
+        return datetime.utcnow().strftime('%Y-%m-%dT00:00:00Z')
+    
+    def _get_existing_keys(self, reload=False):
+        """
+        Get the keys of all documents in paperless-ngx.
+        
+        The documents are listed by paging through their original filenames. The
+        listing is kept until it's reloaded, documents stored in the meantime are
+        added by mark_stored() once all their files are uploaded.
+        
+        Args:
+            reload (bool, optional): List the documents again even if they were listed before
+        
+        Returns:
+            set: Document keys, or None if the documents couldn't be listed
+        """
+        with self._existing_keys_lock:
+            if reload or not self._existing_keys_loaded:
+                self._existing_keys = self._list_document_keys()
+                self._existing_keys_loaded = True
+            return self._existing_keys
+    
+    def _list_document_keys(self):
+        """
+        List the keys of all documents in paperless-ngx from their original filenames.
+        
+        Returns:
+            set: Document keys, or None if the documents couldn't be listed
+        """
+        keys = set()
+        url = f"{self.api_url}/documents/"
+        params = {'fields': 'id,original_filename', 'page_size': DOCUMENTS_PAGE_SIZE}
+        
         try:
-            # Check if date is in YYYY-MM-DD format
-            if re.match(r'^\d{4}-\d{2}-\d{2}$', date_str):
-                # Convert to ISO format with time and timezone
-                return f"{date_str}T00:00:00Z"
-            else:
-                logging.warning(f"Date format not recognized: {date_str}, using current date")
-                return datetime.utcnow().strftime('%Y-%m-%dT00:00:00Z')
+            while url:
+                response = self.session.get(url, params=params)
+                if response.status_code != 200:
+                    logging.error("Failed to list documents: %s, Response: %s", response.status_code, response.text)
+                    return None
+                
+                data = response.json()
+                for document in data.get('results', []):
+                    keys.update(self._keys_from_filename(document.get('original_filename')))
+                
+                # The next page link already carries the query parameters
+                url = data.get('next')
+                params = None
         except Exception as e:
-            logging.error(f"Error formatting date: {str(e)}")
-            return datetime.utcnow().strftime('%Y-%m-%dT00:00:00Z')
+            logging.error("Error listing documents in paperless-ngx: %s", e)
+            return None
+        
+        logging.info("Found %s documents in paperless-ngx", len(keys))
+        return keys
+    
+    def _keys_from_filename(self, filename):
+        """
+        Get the possible document keys from a filename created by store().
+        
+        Correspondent names and keys may both contain underscores, so where the
+        key starts can't always be told. Every candidate after an underscore is
+        returned then, which is still stricter than the filename search exists()
+        falls back to.
+        
+        Args:
+            filename (str): Original filename, {date}_{correspondent}_{key}[_part{n}].{extension}
+            
+        Returns:
+            list: Candidate document keys, empty if the filename isn't one store() creates
+        """
+        match = FILENAME_PATTERN.match(filename or '')
+        if not match:
+            return []
+        
+        # {correspondent}_{key}, the key is the last field when neither has an underscore
+        parts = match.group(1).split('_')
+        return ['_'.join(parts[i:]) for i in range(1, len(parts))]
+    
+    def list_existing_keys(self, doc_type):
+        """
+        List the keys of the documents that already exist in paperless-ngx.
+        
+        Filenames don't tell receipts and letters apart, so the keys of both are
+        returned. Kivra keys are unique across document types. The documents are
+        listed again on every call, so each sync sees what was uploaded since.
+        
+        Args:
+            doc_type (str): Type of document (receipt/letter)
+            
+        Returns:
+            set: Keys of the existing documents, or None if they couldn't be listed
+        """
+        return self._get_existing_keys(reload=True)
+    
+    def mark_stored(self, doc_type, key):
+        """
+        Add a document whose files have all been uploaded to the listing.
+        
+        Args:
+            doc_type (str): Type of document (receipt/letter)
+            key (str): Document key
+        """
+        if self.dry_run:
+            return
+        
+        with self._existing_keys_lock:
+            if self._existing_keys is not None:
+                self._existing_keys.add(key)
     
     def exists(self, metadata):
         """
@@ -256,189 +457,181 @@ class PaperlessNgxStoreProvider(DocumentStoreProvider):
         Returns:
             bool: True if exists, False otherwise
         """
+        # Extract key identifiers from metadata
+        doc_type = metadata.get('type')
+        doc_key = metadata.get('key')
+        
+        if not doc_key:
+            return False
+        
+        # Answer from the document listing when it's available
+        existing_keys = self._get_existing_keys()
+        if existing_keys is not None:
+            return doc_key in existing_keys
+        
+        # Build query parameters with more specific criteria
+        query_params = {
+            'original_filename__icontains': doc_key
+        }
+        
+        logging.info("Checking if document exists with filename params: %s", query_params)
+        
+        # Search for document with the specific criteria
         try:
-            # Extract key identifiers from metadata
-            doc_type = metadata.get('type')
-            doc_key = metadata.get('key')
-            
-            if not doc_key:
-                return False
-            
-            # Build query parameters with more specific criteria
-            query_params = {
-                'original_filename__icontains': doc_key
-            }
-            
-            logging.info(f"Checking if document exists with filename params: {query_params}")
-            
-            # Search for document with the specific criteria
             response = self.session.get(
                 f"{self.api_url}/documents/",
                 params=query_params
             )
             
             if response.status_code != 200:
-                logging.error(f"Failed to search documents by filename: {response.status_code}, Response: {response.text}")
+                logging.error("Failed to search documents by filename: %s, Response: %s", response.status_code, response.text)
                 return False
             
             data = response.json()
-
-            exists = data['count'] > 0
-            
-            if exists:
-                logging.info(f"Document with key {doc_key} already exists in Paperless (by filename)")
-            else:
-                logging.info(f"Document with key {doc_key} does not exist in Paperless (by filename)")
-                
-            return exists
-            
-        except Exception as e:
-            logging.error(f"Error checking if document exists in paperless-ngx: {str(e)}")
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.error("Error checking if document exists in paperless-ngx: %s", e)
             return False
+        
+        exists = data['count'] > 0
+        
+        if exists:
+            logging.info("Document with key %s already exists in Paperless (by filename)", doc_key)
+        else:
+            logging.info("Document with key %s does not exist in Paperless (by filename)", doc_key)
+            
+        return exists
     
     def store(self, data, metadata):
         """
         Store document in paperless-ngx.
         
         Args:
-            data (bytes or dict): The document content
+            data (bytes, file or dict): The document content
             metadata (dict): Document metadata
             
         Returns:
             bool: True if successful, False otherwise
         """
-        try:
-            
-            # Only store PDF and text documents
-            content_type = metadata.get('content_type', '')
-            if content_type not in ['application/pdf', 'text/plain', 'text/html']:
-                return True
-            
-            doc_type = metadata.get('type')
-            date = metadata.get('date', 'unknown_date')
-            
-            # Get correspondent name based on document type
-            if doc_type == 'receipt':
-                correspondent_name = metadata.get('store_name', 'Unknown Store')
-                # Clean up the store name if needed
-                if correspondent_name and '/' in correspondent_name:
-                    correspondent_name = correspondent_name.split('/')[0].strip()
-            else:  # letter
-                correspondent_name = metadata.get('sender_name', 'Unknown Sender')
-            
-            logging.info(f"Using correspondent name: {correspondent_name}")
-            
+        # Only store PDF and text documents
+        content_type = metadata.get('content_type', '')
+        if content_type not in ['application/pdf', 'text/plain', 'text/html']:
+            return True
+        
+        doc_type = metadata.get('type')
+        date = metadata.get('date', 'unknown_date')
+        
+        # Get correspondent name based on document type
+        if doc_type == 'receipt':
+            correspondent_name = metadata.get('store_name', 'Unknown Store')
+            # Clean up the store name if needed
+            if correspondent_name and '/' in correspondent_name:
+                correspondent_name = correspondent_name.split('/')[0].strip()
+        else:  # letter
+            correspondent_name = metadata.get('sender_name', 'Unknown Sender')
+        
+        logging.info("Using correspondent name: %s", correspondent_name)
+        
+        with self._lookup_lock:
             # Get correspondent ID
             correspondent_id = self._get_correspondent_id(correspondent_name)
             
             # Get document type ID
             document_type_id = self._get_document_type_id(doc_type)
-            
-            # Create filename
-            key = metadata.get('key', 'unknown')
-            part_index = metadata.get('part_index')
-            part_suffix = f"_part{part_index}" if part_index is not None else ""
-            
-            if doc_type == 'receipt':
-                filename = f"{date}_{correspondent_name}_{key}{part_suffix}"
-            else:  # letter
-                filename = f"{date}_{correspondent_name}_{key}{part_suffix}"
-            
-            # Prepare file for upload
-            if isinstance(data, dict):
-                # Convert JSON to text
-                file_data = json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
-                file_content_type = 'application/json'
-            elif isinstance(data, str):
-                # For HTML content, we need to convert it to PDF first
-                if content_type == 'text/html':
-                    # Import here to avoid circular imports
-                    from utils.pdf import html_to_pdf
-                    pdf_data = html_to_pdf(data)
-                    if pdf_data:
-                        file_data = pdf_data
-                        file_content_type = 'application/pdf'
-                    else:
-                        # Fallback to text if conversion fails
-                        file_data = data.encode('utf-8')
-                        file_content_type = 'text/plain'
-                elif content_type == 'text/plain':
-                    # Convert plain text to HTML with template, then to PDF
-                    from utils.pdf import text_to_html, html_to_pdf
-                    
-                    # Create a title from the filename
-                    title = filename
-                    
-                    # Convert text to HTML with template
-                    html_content = text_to_html(data, title=title)
-                    
-                    # Convert HTML to PDF
-                    pdf_data = html_to_pdf(html_content)
-                    
-                    if pdf_data:
-                        file_data = pdf_data
-                        file_content_type = 'application/pdf'
-                        file_extension = 'pdf'
-                    else:
-                        # Fallback to original text if conversion fails
-                        file_data = data.encode('utf-8')
-                        file_content_type = 'text/plain'
+        
+        # Create filename
+        key = metadata.get('key', 'unknown')
+        part_index = metadata.get('part_index')
+        part_suffix = f"_part{part_index}" if part_index is not None else ""
+        
+        filename = f"{date}_{correspondent_name}_{key}{part_suffix}"
+        
+        # Prepare file for upload
+        if isinstance(data, dict):
+            # Convert JSON to text
+            file_data = json_dumps_indent(data)
+            file_content_type = 'application/json'
+        elif isinstance(data, str):
+            # For HTML content, we need to convert it to PDF first
+            if content_type == 'text/html':
+                # Import here to avoid circular imports
+                from utils.pdf import html_to_pdf
+                pdf_data = html_to_pdf(data)
+                if pdf_data:
+                    file_data = pdf_data
+                    file_content_type = 'application/pdf'
                 else:
-                    # Other text formats
+                    # Fallback to text if conversion fails
                     file_data = data.encode('utf-8')
                     file_content_type = 'text/plain'
-            else:
-                # Assume bytes (PDF)
-                file_data = data
-                file_content_type = content_type
-            
-            # Prepare file upload
-            file_extension = 'pdf' if file_content_type == 'application/pdf' else 'txt'
-            files = {
-                'document': (f"{filename}.{file_extension}", file_data, file_content_type)
-            }
-            
-            # Prepare metadata
-            document_metadata = {
-                'title': filename,
-                'created': self._format_date_for_paperless(date)
-            }
-            
-            # Only add correspondent and document_type if they are not None
-            if correspondent_id is not None:
-                document_metadata['correspondent'] = correspondent_id
+            elif content_type == 'text/plain':
+                # Convert plain text to PDF with the HTML template
+                from utils.pdf import text_to_pdf
+                
+                # Use the filename as title
+                pdf_data = text_to_pdf(data, title=filename)
                 
-            if document_type_id is not None:
-                document_metadata['document_type'] = document_type_id
+                if pdf_data:
+                    file_data = pdf_data
+                    file_content_type = 'application/pdf'
+                    file_extension = 'pdf'
+                else:
+                    # Fallback to original text if conversion fails
+                    file_data = data.encode('utf-8')
+                    file_content_type = 'text/plain'
+            else:
+                # Other text formats
+                file_data = data.encode('utf-8')
+                file_content_type = 'text/plain'
+        else:
+            # Assume bytes or a file object (PDF), requests accepts both
+            file_data = data
+            file_content_type = content_type
+        
+        # Prepare file upload
+        file_extension = 'pdf' if file_content_type == 'application/pdf' else 'txt'
+        files = {
+            'document': (f"{filename}.{file_extension}", file_data, file_content_type)
+        }
+        
+        # Prepare metadata
+        document_metadata = {
+            'title': filename,
+            'created': self._format_date_for_paperless(date)
+        }
+        
+        # Only add correspondent and document_type if they are not None
+        if correspondent_id is not None:
+            document_metadata['correspondent'] = correspondent_id
             
-            # Add tags if available
-            if self.tag_ids:
-                document_metadata['tags'] = self.tag_ids
-                logging.info(f"Adding tags to document: {self.tag_ids}")
+        if document_type_id is not None:
+            document_metadata['document_type'] = document_type_id
+        
+        # Add tags if available
+        if self.tag_ids:
+            document_metadata['tags'] = self.tag_ids
+            logging.info("Adding tags to document: %s", self.tag_ids)
+        
+        # Check if this is a dry run
+        if self.dry_run:
+            logging.info("DRY RUN: Would upload document to paperless-ngx: %s", filename)
+            return True
             
-            # Check if this is a dry run
-            if self.dry_run:
-                logging.info(f"DRY RUN: Would upload document to paperless-ngx: {filename}")
-                return True
-                
-            # Upload document without custom fields
+        # Upload document without custom fields
+        try:
             response = self.session.post(
                 f"{self.api_url}/documents/post_document/",
                 files=files,
                 data=document_metadata
             )
-            
-            if response.status_code not in [200, 201, 202]:
-                logging.error(f"Failed to upload document to paperless-ngx: {response.status_code}")
-                logging.error(f"Response: {response.text}")
-                return False
-            
-            logging.info(f"Successfully uploaded document to paperless-ngx: {filename}")
-            
-            # Document was uploaded successfully
-            
-            return True
-            
-        except Exception as e:
-            logging.error(f"Error storing document in paperless-ngx: {str(e)}")
+        except requests.exceptions.RequestException as e:
+            logging.error("Error storing document in paperless-ngx: %s", e)
+            return False
+        
+        if response.status_code not in [200, 201, 202]:
+            logging.error("Failed to upload document to paperless-ngx: %s", response.status_code)
+            logging.error("Response: %s", response.text)
             return False
+        
+        logging.info("Successfully uploaded document to paperless-ngx: %s", filename)
+        return True
+
@@ -1,14 +1,58 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import functools
 import unicodedata
 import string
 import logging
+import json
+
+# Use orjson for API payloads when it is installed, it is several times faster
+# than the json module. json_dumps() returns compact UTF-8 encoded bytes,
+# json_dumps_indent() the same indented by two spaces for files meant to be read.
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+    
+    def json_dumps_indent(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+except ImportError:
+    json_loads = json.loads
+    
+    def json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    
+    def json_dumps_indent(obj):
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
 
 # Valid characters for filenames
 valid_filename_chars = "-_.() %s%s" % (string.ascii_letters, string.digits)
 char_limit = 255
 
+# str.translate() tables for clean_filename(), by whitelist and replace characters
+_filename_tables = {}
+
+def _get_filename_tables(whitelist, replace):
+    """
+    Get the translation tables used to clean filenames.
+    
+    Args:
+        whitelist (str): Characters to allow in the filename
+        replace (str): Characters to replace with underscore
+        
+    Returns:
+        tuple: (table replacing the replace characters, table deleting non-whitelisted ASCII)
+    """
+    tables = _filename_tables.get((whitelist, replace))
+    if tables is None:
+        replace_table = str.maketrans({r: '_' for r in replace})
+        delete_table = str.maketrans('', '', ''.join(chr(i) for i in range(128) if chr(i) not in whitelist))
+        tables = _filename_tables[(whitelist, replace)] = (replace_table, delete_table)
+    return tables
+
+# The same store and sender names come up for every one of their documents
+@functools.lru_cache(maxsize=4096)
 def clean_filename(filename, whitelist=valid_filename_chars, replace=' '):
     """
     Clean a filename to ensure it only contains valid characters.
@@ -21,15 +65,19 @@ def clean_filename(filename, whitelist=valid_filename_chars, replace=' '):
     Returns:
         str: Cleaned filename
     """
+    replace_table, delete_table = _get_filename_tables(whitelist, replace)
+    
     # replace spaces
-    for r in replace:
-        filename = filename.replace(r,'_')
+    filename = filename.translate(replace_table)
     
-    # keep only valid ascii chars
-    cleaned_filename = unicodedata.normalize('NFKD', filename).encode('ASCII', 'ignore').decode()
+    # keep only valid ascii chars, ASCII names have nothing to normalize
+    if filename.isascii():
+        cleaned_filename = filename
+    else:
+        cleaned_filename = unicodedata.normalize('NFKD', filename).encode('ASCII', 'ignore').decode()
     
     # keep only whitelisted chars
-    cleaned_filename = ''.join(c for c in cleaned_filename if c in whitelist)
+    cleaned_filename = cleaned_filename.translate(delete_table)
     if len(cleaned_filename) > char_limit:
         logging.warn(f"Warning, filename truncated because it was over {char_limit}. Filenames may no longer be unique")
     return cleaned_filename[:char_limit]
@@ -1,77 +1,108 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-import io
-import logging
+import hashlib
 import html
-from weasyprint import HTML
+import logging
+import logging.handlers
+import queue
+import atexit
+import threading
+import collections
+from weasyprint import HTML, CSS
+from weasyprint.text.fonts import FontConfiguration
+
+# WeasyPrint log records are written to weasyprint.log from a background
+# thread, so renders don't wait for the file
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.FileHandler('./weasyprint.log'))
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
 # Configure weasyprint logging
 logger = logging.getLogger('weasyprint')
 logger.setLevel(logging.ERROR)
-logger.handlers = [logging.FileHandler('./weasyprint.log')]  # Remove the default stderr handler
+logger.handlers = [logging.handlers.QueueHandler(_log_queue)]  # Remove the default stderr handler
 
-def text_to_html(text_content, title=None):
-    """
-    Convert plain text to HTML with a clean, readable template.
-    
-    Args:
-        text_content (str): Plain text content to convert
-        title (str, optional): Title to display in the HTML
-        
-    Returns:
-        str: HTML content
-    """
-    # Escape HTML special characters
-    escaped_text = html.escape(text_content)
-    
-    # Replace newlines with <br> tags and preserve whitespace
-    formatted_text = escaped_text.replace('\n', '<br>')
-    
-    # Create HTML with a clean template
-    html_content = f"""<!DOCTYPE html>
+# Characters html.escape() replaces. Most messages have none of them, and
+# looking for each with a substring search is cheaper than escaping.
+_HTML_SPECIAL_CHARS = ('&', '<', '>', '"', "'")
+
+# Style for text_to_html() documents. It is parsed once into TEXT_STYLESHEET
+# and handed to WeasyPrint rather than inlined into every document.
+_TEXT_CSS = """
+body {
+    font-family: Arial, sans-serif;
+    line-height: 1.6;
+    margin: 2cm;
+    color: #333;
+}
+.container {
+    max-width: 800px;
+    margin: 0 auto;
+}
+.header {
+    border-bottom: 1px solid #ddd;
+    padding-bottom: 10px;
+    margin-bottom: 20px;
+}
+.content {
+    white-space: pre-wrap;
+    font-family: monospace;
+    background-color: #f9f9f9;
+    padding: 15px;
+    border-radius: 5px;
+}
+.footer {
+    margin-top: 30px;
+    font-size: 0.8em;
+    color: #777;
+    text-align: center;
+}
+"""
+
+TEXT_STYLESHEET = CSS(string=_TEXT_CSS)
+
+# Font configurations are reused across renders, one per thread as they wrap
+# Pango font maps that aren't safe to share between threads
+_font_configs = threading.local()
+
+# Set once warm_up() has started its render
+_warmed_up = threading.Event()
+
+# Blank HTML always renders to the same blank page, see _get_empty_pdf()
+_empty_pdf = None
+
+# Total size of the rendered PDFs kept for documents that come up again, and
+# the largest single PDF that is kept
+PDF_CACHE_MAX_BYTES = 16 * 1024 * 1024
+PDF_CACHE_MAX_ITEM_BYTES = 1024 * 1024
+
+# Rendered PDFs by hash of their HTML, least recently used first, and their total size
+_pdf_cache = collections.OrderedDict()
+_pdf_cache_bytes = 0
+_pdf_cache_lock = threading.Lock()
+
+# Fixed parts of the text_to_html() template, the title and text go in between
+_HTML_PREFIX = """<!DOCTYPE html>
 <html>
 <head>
     <meta charset="UTF-8">
-    <title>{title or 'Document'}</title>
-    <style>
-        body {{
-            font-family: Arial, sans-serif;
-            line-height: 1.6;
-            margin: 2cm;
-            color: #333;
-        }}
-        .container {{
-            max-width: 800px;
-            margin: 0 auto;
-        }}
-        .header {{
-            border-bottom: 1px solid #ddd;
-            padding-bottom: 10px;
-            margin-bottom: 20px;
-        }}
-        .content {{
-            white-space: pre-wrap;
-            font-family: monospace;
-            background-color: #f9f9f9;
-            padding: 15px;
-            border-radius: 5px;
-        }}
-        .footer {{
-            margin-top: 30px;
-            font-size: 0.8em;
-            color: #777;
-            text-align: center;
-        }}
-    </style>
+    <title>"""
+
+_HTML_MID_TITLE = """</title>
 </head>
 <body>
     <div class="container">
         <div class="header">
-            <h1>{title or 'Document'}</h1>
+            <h1>"""
+
+_HTML_MID_BODY = """</h1>
         </div>
         <div class="content">
-{formatted_text}
+"""
+
+_HTML_SUFFIX = """
         </div>
         <div class="footer">
             Converted from plain text
@@ -79,23 +110,218 @@ def text_to_html(text_content, title=None):
     </div>
 </body>
 </html>"""
+
+def text_to_html(text_content, title=None):
+    """
+    Convert plain text to HTML with a clean, readable template.
+    
+    The template is styled by TEXT_STYLESHEET, use text_to_pdf() to render it.
+    
+    Args:
+        text_content (str): Plain text content to convert
+        title (str, optional): Title to display in the HTML
+        
+    Returns:
+        str: HTML content
+    """
+    # Escape HTML special characters, then replace newlines with <br> tags. Both
+    # are single C loops over the text and beat a one-pass translate() or regex
+    # sub(), which call back into Python for every character or match.
+    if any(char in text_content for char in _HTML_SPECIAL_CHARS):
+        text_content = html.escape(text_content)
+    formatted_text = text_content.replace('\n', '<br>')
     
-    return html_content
+    # Fill in the template, joining the parts allocates the result only once. The
+    # title is a letter subject or filename and is escaped like the text.
+    title = html.escape(title or 'Document')
+    return "".join((_HTML_PREFIX, title, _HTML_MID_TITLE, title, _HTML_MID_BODY, formatted_text, _HTML_SUFFIX))
 
-def html_to_pdf(html_content):
+def _get_font_config():
+    """
+    Get the font configuration for the current thread, creating it on first use.
+    
+    Returns:
+        FontConfiguration: Font configuration to render with
+    """
+    font_config = getattr(_font_configs, 'font_config', None)
+    if font_config is None:
+        font_config = _font_configs.font_config = FontConfiguration()
+    return font_config
+
+def _no_url_fetcher(url):
+    """
+    URL fetcher for documents that never reference external resources.
+    
+    Args:
+        url (str): URL WeasyPrint wants to fetch
+        
+    Raises:
+        ValueError: Always, nothing is fetched
+    """
+    raise ValueError(f"Not fetching {url}, text documents have no external resources")
+
+def _get_empty_pdf():
+    """
+    Get the PDF for a blank HTML document, rendering it on first use.
+    
+    Returns:
+        bytes: PDF content as bytes
+    """
+    global _empty_pdf
+    if _empty_pdf is None:
+        _empty_pdf = HTML(string='').write_pdf(font_config=_get_font_config())
+    return _empty_pdf
+
+def _get_cached_pdf(cache_key):
+    """
+    Get a previously rendered PDF from the cache.
+    
+    Args:
+        cache_key (bytes): Hash of the HTML content
+        
+    Returns:
+        bytes: PDF content as bytes, or None if it isn't cached
+    """
+    with _pdf_cache_lock:
+        pdf_data = _pdf_cache.get(cache_key)
+        if pdf_data is not None:
+            _pdf_cache.move_to_end(cache_key)
+        return pdf_data
+
+def _cache_pdf(cache_key, pdf_data):
+    """
+    Add a rendered PDF to the cache, evicting the least recently used ones
+    until the cache fits in PDF_CACHE_MAX_BYTES.
+    
+    Args:
+        cache_key (bytes): Hash of the HTML content
+        pdf_data (bytes): PDF content
+    """
+    global _pdf_cache_bytes
+    if len(pdf_data) > PDF_CACHE_MAX_ITEM_BYTES:
+        return
+    
+    with _pdf_cache_lock:
+        previous = _pdf_cache.pop(cache_key, None)
+        if previous is not None:
+            _pdf_cache_bytes -= len(previous)
+        _pdf_cache[cache_key] = pdf_data
+        _pdf_cache_bytes += len(pdf_data)
+        while _pdf_cache_bytes > PDF_CACHE_MAX_BYTES:
+            _, evicted = _pdf_cache.popitem(last=False)
+            _pdf_cache_bytes -= len(evicted)
+
+def _write_pdf_data(pdf_data, target):
+    """
+    Hand out an already rendered PDF the way html_to_pdf() would.
+    
+    Args:
+        pdf_data (bytes): PDF content
+        target (str or file): File path or binary file object to write to, or None
+        
+    Returns:
+        bytes: PDF content if there is no target, True otherwise
+    """
+    if target is None:
+        return pdf_data
+    if isinstance(target, str):
+        with open(target, 'wb') as f:
+            f.write(pdf_data)
+    else:
+        target.write(pdf_data)
+    return True
+
+def html_to_pdf(html_content, stylesheets=None, url_fetcher=None, target=None):
     """
     Convert HTML content to PDF.
     
     Args:
         html_content (str): HTML content to convert
+        stylesheets (list, optional): Parsed CSS stylesheets to apply in addition to the document's own
+        url_fetcher (callable, optional): Fetcher for images and other linked resources.
+                                          Defaults to WeasyPrint's own.
+        target (str or file, optional): File path or binary file object to write the PDF to.
+                                        The PDF is returned as bytes if not given.
         
     Returns:
-        bytes: PDF content as bytes, or None if conversion failed
+        bytes: PDF content as bytes, True if it was written to target, or None if conversion failed
     """
     try:
-        pdf_buffer = io.BytesIO()
-        HTML(string=html_content).write_pdf(pdf_buffer)
-        return pdf_buffer.getvalue()
+        # Blank documents don't need a full layout, reuse the one blank page
+        if stylesheets is None and (not html_content or html_content.isspace()):
+            return _write_pdf_data(_get_empty_pdf(), target)
+        
+        # Documents rendered to bytes with the defaults are cached, letters with
+        # identical bodies come up again. Renders straight into a target are
+        # never added to the cache, so they don't look it up either.
+        cache_key = None
+        if stylesheets is None and url_fetcher is None and target is None:
+            cache_key = hashlib.blake2b(html_content.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+            pdf_data = _get_cached_pdf(cache_key)
+            if pdf_data is not None:
+                return _write_pdf_data(pdf_data, target)
+        
+        if url_fetcher is not None:
+            document = HTML(string=html_content, url_fetcher=url_fetcher)
+        else:
+            document = HTML(string=html_content)
+        
+        # WeasyPrint returns the PDF as bytes when there is no target. With one it
+        # writes straight to it, skipping the in-memory copy.
+        pdf_data = document.write_pdf(
+            target,
+            stylesheets=stylesheets,
+            font_config=_get_font_config()
+        )
+        if target is not None:
+            return True
+        
+        if cache_key is not None:
+            _cache_pdf(cache_key, pdf_data)
+        return pdf_data
     except Exception as e:
-        logging.error(f"Error converting HTML to PDF: {str(e)}")
+        logging.error("Error converting HTML to PDF: %s", e)
         return None
+
+def _text_html_to_pdf(html_content):
+    """
+    Convert HTML created by text_to_html() to PDF with the parsed text stylesheet.
+    
+    Args:
+        html_content (str): HTML content from text_to_html()
+        
+    Returns:
+        bytes: PDF content as bytes, or None if conversion failed
+    """
+    # The template has no images or links, so WeasyPrint never needs to fetch anything
+    return html_to_pdf(html_content, stylesheets=[TEXT_STYLESHEET], url_fetcher=_no_url_fetcher)
+
+def text_to_pdf(text_content, title=None):
+    """
+    Convert plain text to PDF using the text_to_html() template.
+    
+    Args:
+        text_content (str): Plain text content to convert
+        title (str, optional): Title to display in the document
+        
+    Returns:
+        bytes: PDF content as bytes, or None if conversion failed
+    """
+    return _text_html_to_pdf(text_to_html(text_content, title=title))
+
+def warm_up():
+    """
+    Render a throwaway document on a background thread.
+    
+    The first render in a process loads Pango and has fontconfig build its
+    process-wide font cache, which can take seconds on a cold start. Calling
+    this while waiting for something else, like authentication, takes that off
+    the first real conversion. The FontConfiguration it creates belongs to the
+    warm-up thread, worker threads still create their own. Only the first call
+    does anything.
+    """
+    if _warmed_up.is_set():
+        return
+    _warmed_up.set()
+    
+    threading.Thread(target=text_to_pdf, args=('',), name='pdf-warm-up', daemon=True).start()
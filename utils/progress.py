@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import sys
+import threading
+import time
+
+class ProgressReporter:
+    """
+    Thread-safe progress output for items processed by concurrent workers.
+
+    On a terminal a single status line is redrawn in place, otherwise a line is
+    printed at most every few seconds so logs don't fill up.
+    """
+
+    def __init__(self, total, label, interval=0.5):
+        """
+        Initialize the progress reporter.
+
+        Args:
+            total (int): Number of items that will be processed
+            label (str): Label to show in front of the counts, e.g. "Letters"
+            interval (float, optional): Minimum seconds between updates on a terminal. Defaults to 0.5.
+        """
+        self.total = total
+        self.label = label
+        self.done = 0
+        self.stored = 0
+        self._tty = sys.stdout.isatty()
+        self._interval = interval if self._tty else max(interval, 10.0)
+        self._last_output = 0.0
+        self._lock = threading.Lock()
+
+    def update(self, stored=0):
+        """
+        Record that an item has been processed.
+
+        Args:
+            stored (int, optional): Number of new items stored while processing it
+        """
+        with self._lock:
+            self.done += 1
+            self.stored += stored
+
+            now = time.monotonic()
+            if self.done < self.total and now - self._last_output < self._interval:
+                return
+            self._last_output = now
+
+            line = f"{self.label}: {self.done}/{self.total} processed, {self.stored} new"
+            if self._tty:
+                sys.stdout.write(f"\r{line}")
+                sys.stdout.flush()
+            else:
+                print(line)
+
+    def close(self):
+        """End the status line once all items have been processed."""
+        with self._lock:
+            if self._tty and self.done:
+                sys.stdout.write("\n")
+                sys.stdout.flush()